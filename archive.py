@@ -0,0 +1,359 @@
+import errno
+import fcntl
+import os
+import json
+import mmap
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+import logging
+
+logger = logging.getLogger('email_service')
+
+# Segments are sealed once they grow past this size
+SEGMENT_SIZE = int(os.environ.get('ARCHIVE_SEGMENT_SIZE', str(64 * 1024 * 1024)))    # bytes
+RETENTION_DAYS = float(os.environ.get('ARCHIVE_RETENTION_DAYS', '90'))
+# A sealed segment is rewritten once less than this fraction of it is still live
+COMPACT_THRESHOLD = float(os.environ.get('ARCHIVE_COMPACT_THRESHOLD', '0.5'))
+
+# Record layout: magic, PDF length, payload length, CRC-32 of the PDF, then
+# the PDF and the receipt payload (JSON) back to back
+_HEADER = struct.Struct('>4sIII')
+_MAGIC = b'RCB1'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    comprovante TEXT,
+    id_pagamento TEXT,
+    numero_lote TEXT,
+    recipient TEXT,
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    pdf_length INTEGER NOT NULL,
+    payload_length INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS receipts_comprovante ON receipts (comprovante);
+CREATE INDEX IF NOT EXISTS receipts_id_pagamento ON receipts (id_pagamento);
+CREATE INDEX IF NOT EXISTS receipts_numero_lote ON receipts (numero_lote);
+CREATE INDEX IF NOT EXISTS receipts_segment ON receipts (segment);
+CREATE INDEX IF NOT EXISTS receipts_created_at ON receipts (created_at);
+"""
+
+_COLUMNS = ('id', 'comprovante', 'id_pagamento', 'numero_lote', 'recipient',
+            'segment', 'offset', 'pdf_length', 'payload_length', 'created_at')
+
+# Keys a receipt can be looked up by
+LOOKUP_KEYS = ('comprovante', 'id_pagamento', 'numero_lote')
+
+
+class ArchiveLocked(Exception):
+    """Another process is already writing to the archive directory."""
+
+
+class Archive:
+    """
+    Append-only store of rendered receipts with a SQLite index.
+
+    PDFs and their payloads are appended to numbered segment files
+    (seg-000001.dat, ...); the index maps comprovante, id_pagamento and
+    numero_lote to a (segment, offset). Data is written before its index row
+    is committed, so a crash can only leave unreferenced bytes behind, which
+    compaction reclaims. Offsets come from the writer's own file position,
+    so one process writes to a directory at a time: it holds an exclusive
+    lock on writer.lock, and a second writer gets ArchiveLocked. With
+    readonly=True the archive can be searched and read (not written or
+    compacted) alongside the writer. Any number of threads may read and
+    write within the process.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, retention_days=RETENTION_DAYS, readonly=False):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention = retention_days * 86400
+        self.readonly = readonly
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+        if not readonly:
+            self._lock_file = open(os.path.join(directory, 'writer.lock'), 'a')
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                self._lock_file.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    raise ArchiveLocked(f"Archive {directory} is in use by another process")
+                raise
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._maps_lock = threading.Lock()
+        self._maps = {}             # segment -> mmap
+        self._compacting = threading.Lock()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        conn.commit()
+        segments = self.segments()
+        self._active = segments[-1] if segments else 1
+        self._file = None if readonly else open(self._path(self._active), 'ab')
+
+    def _conn(self):
+        # One connection per thread, as in outbox.Outbox
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(os.path.join(self.directory, 'index.db'), timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _path(self, segment):
+        return os.path.join(self.directory, f"seg-{segment:06d}.dat")
+
+    def segments(self):
+        """Numbers of the segment files on disk, in order."""
+        return sorted(int(name[4:10]) for name in os.listdir(self.directory)
+                      if name.startswith('seg-') and name.endswith('.dat'))
+
+    def put(self, data, pdf_content):
+        """
+        Append a rendered receipt and index it.
+
+        Args:
+            data (dict): Receipt payload
+            pdf_content (bytes): Rendered PDF
+
+        Returns:
+            int: Archive id of the receipt
+        """
+        payment_data = data.get('data', {}).get('dados_pagamento', {})
+        payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        header = _HEADER.pack(_MAGIC, len(pdf_content), len(payload), zlib.crc32(pdf_content))
+        self._check_writable()
+        rolled = False
+        with self._write_lock:
+            segment, offset = self._active, self._file.tell()
+            self._file.write(header)
+            self._file.write(pdf_content)
+            self._file.write(payload)
+            self._file.flush()
+            conn = self._conn()
+            with conn:
+                cursor = conn.execute(
+                    'INSERT INTO receipts (comprovante, id_pagamento, numero_lote, recipient, segment, offset, '
+                    'pdf_length, payload_length, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (payment_data.get('comprovante'), payment_data.get('id_pagamento'),
+                     _text(payment_data.get('numero_lote')), data.get('email'), segment, offset,
+                     len(pdf_content), len(payload), time.time()))
+            if self._file.tell() >= self.segment_size:
+                self._roll()
+                rolled = True
+        if rolled:
+            # Expired data is reclaimed whenever a segment is sealed
+            threading.Thread(target=self.compact, kwargs={'wait': False}, name='archive-compact',
+                             daemon=True).start()
+        return cursor.lastrowid
+
+    def _check_writable(self):
+        if self.readonly:
+            raise ArchiveLocked(f"Archive {self.directory} was opened read-only")
+
+    def _roll(self):
+        self._file.close()
+        self._active += 1
+        self._file = open(self._path(self._active), 'ab')
+
+    def find(self, comprovante=None, id_pagamento=None, numero_lote=None, limit=1000):
+        """Unexpired index entries matching every given key, newest first."""
+        # The unary + keeps SQLite on the key's index instead of created_at's
+        clauses, params = ['+created_at >= ?'], [time.time() - self.retention]
+        for key, value in (('comprovante', comprovante), ('id_pagamento', id_pagamento),
+                           ('numero_lote', _text(numero_lote))):
+            if value is not None:
+                clauses.append(f"{key} = ?")
+                params.append(value)
+        if len(clauses) == 1:
+            raise ValueError(f"One of {', '.join(LOOKUP_KEYS)} is required")
+        rows = self._conn().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM receipts WHERE {' AND '.join(clauses)} "
+            f"ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def _view(self, segment, offset, length):
+        """Zero-copy view of length bytes at offset in a segment."""
+        end = offset + length
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                if segment == self._active and self._file is not None:
+                    # Make sure buffered appends are visible to the mapping
+                    with self._write_lock:
+                        self._file.flush()
+                with open(self._path(segment), 'rb') as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # A replaced mapping stays alive while views of it exist
+                self._maps[segment] = mapped
+        return memoryview(mapped)[offset:end]
+
+    def read(self, entry):
+        """
+        PDF and payload of an index entry.
+
+        Returns:
+            tuple: (memoryview over the PDF in the mapped segment, payload dict)
+        """
+        view = self._view(entry['segment'], entry['offset'],
+                          _HEADER.size + entry['pdf_length'] + entry['payload_length'])
+        magic, pdf_length, payload_length, crc = _HEADER.unpack(view[:_HEADER.size])
+        pdf = view[_HEADER.size:_HEADER.size + pdf_length]
+        if magic != _MAGIC or pdf_length != entry['pdf_length'] or zlib.crc32(pdf) != crc:
+            raise ValueError(f"Corrupt archive record {entry['id']} in segment {entry['segment']}")
+        payload = json.loads(bytes(view[_HEADER.size + pdf_length:]).decode('utf-8'))
+        return pdf, payload
+
+    def get(self, comprovante=None, id_pagamento=None):
+        """
+        Newest receipt with the given comprovante or id_pagamento.
+
+        Returns:
+            tuple: (index entry, PDF memoryview, payload dict), or None
+        """
+        for attempt in range(2):
+            entries = self.find(comprovante=comprovante, id_pagamento=id_pagamento, limit=1)
+            if not entries:
+                return None
+            try:
+                return (entries[0],) + self.read(entries[0])
+            except FileNotFoundError:
+                # Compaction moved the record between the lookup and the read
+                if attempt:
+                    raise
+
+    def expire(self, now=None):
+        """Drop index entries older than the retention period. Returns how many."""
+        cutoff = (now or time.time()) - self.retention
+        conn = self._conn()
+        with conn:
+            return conn.execute('DELETE FROM receipts WHERE created_at < ?', (cutoff,)).rowcount
+
+    def compact(self, threshold=COMPACT_THRESHOLD, wait=True):
+        """
+        Expire old entries and reclaim space in sealed segments.
+
+        Segments with no live records are deleted. Segments where less than
+        threshold of the bytes are still referenced have their live records
+        copied to the active segment and are then deleted. With wait=False
+        nothing is done if another compaction is already running.
+
+        Returns:
+            dict: Entries expired, segments deleted and records moved
+        """
+        self._check_writable()
+        if not self._compacting.acquire(blocking=wait):
+            return {'expired': 0, 'deleted_segments': 0, 'moved_records': 0}
+        try:
+            expired = self.expire()
+            deleted = moved = 0
+            conn = self._conn()
+            for segment in self.segments():
+                if segment == self._active:
+                    continue
+                path = self._path(segment)
+                live = conn.execute(
+                    f"SELECT {', '.join(_COLUMNS)} FROM receipts WHERE segment = ? ORDER BY offset",
+                    (segment,)).fetchall()
+                live_bytes = sum(_HEADER.size + row[7] + row[8] for row in live)
+                if live and live_bytes >= threshold * os.path.getsize(path):
+                    continue
+                for row in live:
+                    self._move(dict(zip(_COLUMNS, row)))
+                    moved += 1
+                with self._maps_lock:
+                    self._maps.pop(segment, None)
+                os.remove(path)
+                deleted += 1
+            if expired or deleted:
+                logger.info("Archive compacted: %s expired, %s segments deleted, %s records moved",
+                            expired, deleted, moved)
+            return {'expired': expired, 'deleted_segments': deleted, 'moved_records': moved}
+        finally:
+            self._compacting.release()
+
+    def _move(self, entry):
+        length = _HEADER.size + entry['pdf_length'] + entry['payload_length']
+        record = bytes(self._view(entry['segment'], entry['offset'], length))
+        with self._write_lock:
+            segment, offset = self._active, self._file.tell()
+            self._file.write(record)
+            self._file.flush()
+            conn = self._conn()
+            with conn:
+                conn.execute('UPDATE receipts SET segment = ?, offset = ? WHERE id = ?',
+                             (segment, offset, entry['id']))
+            if self._file.tell() >= self.segment_size:
+                self._roll()
+
+    def stats(self):
+        """Number of indexed receipts and segment files, and bytes on disk."""
+        segments = self.segments()
+        return {
+            'receipts': self._conn().execute('SELECT COUNT(*) FROM receipts').fetchone()[0],
+            'segments': len(segments),
+            'bytes': sum(os.path.getsize(self._path(segment)) for segment in segments),
+        }
+
+    def close(self):
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+        with self._maps_lock:
+            self._maps.clear()
+        if self._lock_file is not None:
+            # Closing the file releases the writer lock
+            self._lock_file.close()
+
+
+def _text(value):
+    return None if value is None else str(value)
+
+
+def main():
+    """Look up archived receipts, or compact the archive configured in ARCHIVE_DIR."""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Receipt archive maintenance')
+    parser.add_argument('command', choices=('stats', 'compact', 'find', 'export'))
+    parser.add_argument('--dir', default=os.environ.get('ARCHIVE_DIR'))
+    for key in LOOKUP_KEYS:
+        parser.add_argument(f"--{key.replace('_', '-')}", dest=key)
+    parser.add_argument('--output', help='file for export (default: <comprovante>.pdf)')
+    args = parser.parse_args()
+    if not args.dir:
+        parser.error('--dir or ARCHIVE_DIR is required')
+
+    try:
+        # Only compaction writes; the rest can run next to the service
+        archive = Archive(args.dir, readonly=args.command != 'compact')
+    except ArchiveLocked as e:
+        parser.exit(1, f"{e}; the writing process compacts it whenever a segment is sealed\n")
+    if args.command == 'stats':
+        print(json.dumps(archive.stats()))
+    elif args.command == 'compact':
+        print(json.dumps(archive.compact()))
+    elif args.command == 'find':
+        print(json.dumps(archive.find(args.comprovante, args.id_pagamento, args.numero_lote), indent=2))
+    else:
+        found = archive.get(args.comprovante, args.id_pagamento)
+        if found is None:
+            parser.exit(1, 'Receipt not found\n')
+        entry, pdf, _ = found
+        output = args.output or f"{entry['comprovante'] or entry['id_pagamento']}.pdf"
+        with open(output, 'wb') as f:
+            f.write(pdf)
+        print(output)
+    archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Append and lookup cost of the receipt archive as it grows.
+
+Fills a scratch archive with --receipts records (real PDFs, unique
+comprovante/id_pagamento, 1000 per numero_lote) and reports appends/sec plus
+lookup latency percentiles by comprovante at that size.
+
+    python benchmarks/bench_archive.py --receipts 1000000 --dir /mnt/scratch/archive
+"""
+import argparse
+import io
+import json
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import common
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1_000_000, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=5000)
+    parser.add_argument('--dir', help='archive directory (default: a temporary one, removed afterwards)')
+    args = parser.parse_args()
+
+    import main as handler
+    from archive import Archive
+
+    base = common.load_payload()
+    buffer = io.BytesIO()
+    handler.generate_pdf(base, buffer)
+    pdf_content = buffer.getvalue()
+
+    directory = args.dir or tempfile.mkdtemp(prefix='recibo-archive-')
+    archive = Archive(directory)
+    try:
+        data = common.payload_variant(base, 0)
+        payment = data['data']['dados_pagamento']
+        start = time.perf_counter()
+        for n in range(args.receipts):
+            payment['comprovante'] = f"C{n:012d}"
+            payment['id_pagamento'] = f"P{n:012d}"
+            payment['numero_lote'] = str(n // 1000)
+            archive.put(data, pdf_content)
+        append_elapsed = time.perf_counter() - start
+
+        rng = random.Random(0)
+        lookups = []
+        for _ in range(args.lookups):
+            n = rng.randrange(args.receipts)
+            start = time.perf_counter()
+            entry, pdf, _ = archive.get(comprovante=f"C{n:012d}")
+            lookups.append(time.perf_counter() - start)
+            assert entry['id_pagamento'] == f"P{n:012d}" and len(pdf) == len(pdf_content)
+
+        print(json.dumps({
+            'receipts': args.receipts,
+            'appends_per_sec': round(args.receipts / append_elapsed, 1),
+            'lookup_us': {str(p): percentile(lookups, p) for p in (50, 90, 99)},
+            'archive': archive.stats(),
+        }, indent=2))
+    finally:
+        archive.close()
+        if not args.dir:
+            shutil.rmtree(directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
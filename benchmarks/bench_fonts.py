@@ -0,0 +1,90 @@
+"""
+Compare receipts/sec with embedded TrueType fonts against the base-14 path.
+
+Each mode runs in its own process so font registration happens exactly as it
+would in a fresh Lambda container, --repeat times alternating between the
+modes, and the best run of each is compared so a noisy neighbour does not
+decide the result. Exits with status 1 when the embedded path
+is slower than the base-14 path by more than --tolerance, and with status 2
+(nothing compared) when no TrueType family is installed.
+
+    python benchmarks/bench_fonts.py --receipts 200
+"""
+import argparse
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+def run(receipts):
+    import common
+    import main
+    import fonts
+
+    base = common.load_payload()
+    payloads = [common.payload_variant(base, n) for n in range(receipts)]
+
+    start = time.perf_counter()
+    with common.quiet():
+        main.generate_pdf(payloads[0], io.BytesIO())
+    first = time.perf_counter() - start
+
+    sizes = 0
+    start = time.perf_counter()
+    with common.quiet():
+        for data in payloads:
+            buffer = io.BytesIO()
+            main.generate_pdf(data, buffer)
+            sizes += buffer.tell()
+    elapsed = time.perf_counter() - start
+
+    family = fonts.get_family()
+    return {
+        'font': family.normal,
+        'embedded': family.embedded,
+        'first_receipt_ms': round(first * 1000, 2),
+        'receipts_per_sec': round(receipts / elapsed, 1),
+        'avg_pdf_bytes': sizes // receipts,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed throughput loss of the embedded path (fraction)')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.receipts)))
+        return 0
+
+    results = {}
+    for _ in range(args.repeat):
+        for mode, embed in (('base14', '0'), ('embedded', '1')):
+            env = dict(os.environ, RECIBO_EMBED_FONTS=embed)
+            out = subprocess.run([sys.executable, __file__, '--child', '--receipts', str(args.receipts)],
+                                 env=env, check=True, capture_output=True, text=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            runs = results.setdefault(mode, dict(result, runs=[]))['runs']
+            runs.append(result['receipts_per_sec'])
+            results[mode]['receipts_per_sec'] = max(runs)
+    print(json.dumps(results, indent=2))
+
+    if not results['embedded']['embedded']:
+        print('SKIPPED: no TrueType family found (see fonts.FONT_DIRS); nothing was compared', file=sys.stderr)
+        return 2
+    floor = results['base14']['receipts_per_sec'] * (1 - args.tolerance)
+    if results['embedded']['receipts_per_sec'] < floor:
+        print(f"Embedded fonts regressed throughput below {floor:.1f} receipts/sec")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
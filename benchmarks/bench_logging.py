@@ -0,0 +1,100 @@
+"""
+Per-receipt CPU cost of logging in the calling thread.
+
+Replays the log calls of one successful lambda_handler invocation against
+the previous setup (logging.basicConfig, f-strings, json.dumps(event) and
+the generate_pdf prints) and against logutil in a few configurations.
+Output goes to /dev/null, so only formatting and hand-off are measured.
+
+    python benchmarks/bench_logging.py --receipts 20000
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+
+import common
+import logutil
+
+fields = logutil.fields
+
+
+def legacy_receipt(logger, event, data):
+    logger.info("Lambda function started")
+    logger.info(f"Event received: {json.dumps(event)}")
+    logger.info(f"Processing data for email: {data.get('email')}")
+    logger.info("Generating PDF...")
+    print("Starting PDF generation...")
+    print("Current directory contents:", os.listdir('.'))
+    print("/tmp directory contents:", os.listdir('/tmp'))
+    print("Building final PDF...")
+    print("PDF built successfully")
+    logger.info(f"PDF generated at: {'/tmp/recibo.pdf'}")
+    logger.info("Reading PDF file for base64 encoding...")
+    logger.info(f"Preparing to send email to: {data['email']}")
+    logger.info(f"Email sent successfully to {data['email']}")
+    logger.info("Lambda function completed successfully")
+
+
+def structured_receipt(logger, event, data):
+    logutil.begin_invocation(request_id=None)
+    logger.debug("Lambda function started")
+    logger.debug("Event received", extra=fields(event_keys=sorted(event), body_chars=len(event['body'])))
+    logutil.bind(id_pagamento=data['data']['dados_pagamento']['id_pagamento'])
+    logger.debug("Processing data", extra=fields(email=data.get('email')))
+    logger.debug("Starting PDF generation")
+    logger.debug("Building final PDF")
+    logger.debug("Preparing to send email", extra=fields(recipient=data['email']))
+    logger.info("Receipt processed", extra=fields(
+        recipient=data['email'], email_sent=True, email_queued=False, pdf_bytes=38253, elapsed_ms=12.5))
+
+
+def measure(receipt, logger, event, data, receipts):
+    receipt(logger, event, data)
+    # CPU time of this thread only; the listener thread's formatting is not charged to the receipt
+    start = time.thread_time()
+    for _ in range(receipts):
+        receipt(logger, event, data)
+    elapsed = time.thread_time() - start
+    return round(elapsed / receipts * 1_000_000, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=20000)
+    args = parser.parse_args()
+
+    data = common.load_payload()
+    event = {'body': json.dumps(data)}
+    results = {}
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        saved_stderr, sys.stderr = sys.stderr, devnull
+        try:
+            legacy = logging.getLogger('bench_legacy')
+            handler = logging.StreamHandler(devnull)
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            legacy.addHandler(handler)
+            legacy.setLevel(logging.INFO)
+            legacy.propagate = False
+            results['legacy_us'] = measure(legacy_receipt, legacy, event, data, args.receipts)
+
+            for name, env in (('sync_json_us', {'LOG_ASYNC': '0'}),
+                              ('async_json_us', {'LOG_ASYNC': '1'}),
+                              ('async_sampled_10pct_us', {'LOG_ASYNC': '1', 'LOG_SAMPLE_RATES': 'INFO=0.1'})):
+                os.environ.pop('LOG_SAMPLE_RATES', None)
+                os.environ.update(env)
+                logger = logutil.configure('bench_structured')
+                results[name] = measure(structured_receipt, logger, event, data, args.receipts)
+                logutil.flush(timeout=30)
+            logutil.stop()
+        finally:
+            sys.stderr = saved_stderr
+    print(json.dumps({'receipts': args.receipts, 'per_receipt': results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,106 @@
+"""
+Peak-memory regression gate for the receipt handler.
+
+Measures the tracemalloc peak of a single lambda_handler invocation (per
+stage, via memprof) and of a batch of invocations, and compares them with the
+values recorded in memory_baseline.json. Exits with status 1 when any metric
+grows more than --tolerance over the baseline.
+
+    python benchmarks/bench_memory.py              # check
+    python benchmarks/bench_memory.py --update     # record a new baseline
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tracemalloc
+
+os.environ['RECIBO_MEMPROFILE'] = '1'
+
+import common  # noqa: E402  (sets up the environment main.py needs)
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'memory_baseline.json')
+
+
+def measure(batch):
+    import main
+    import memprof
+    import reportlab
+
+    base = common.load_payload()
+    # The e-mail is built and serialized (the MIME and base64 copies of the
+    # PDF) but not sent: the gate covers memory, not SMTP
+    main.smtp_send = lambda recipient_email, message_bytes, keepalive=None: None
+
+    with common.quiet():
+        # Warm call so one-time initialization is not counted per receipt
+        main.lambda_handler(base, None)
+        peaks = []
+        for n in range(5):
+            main.lambda_handler(common.payload_variant(base, n), None)
+            peaks.append(memprof.last_report())
+    report = min(peaks, key=lambda r: r['peak_bytes'])
+
+    # Batch: one tracemalloc window around the whole loop
+    memprof.ENABLED = False
+    rss_before = memprof.current_rss()
+    tracemalloc.start()
+    with common.quiet():
+        for n in range(batch):
+            main.lambda_handler(common.payload_variant(base, n), None)
+    _, batch_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss_after = memprof.current_rss()
+
+    return {
+        'python': platform.python_version(),
+        'reportlab': reportlab.Version,
+        'receipt_peak_bytes': report['peak_bytes'],
+        'stages': {s['stage']: s['peak_bytes'] for s in report['stages']},
+        'batch_size': batch,
+        'batch_peak_bytes': batch_peak,
+        'batch_rss_growth_bytes': rss_after - rss_before if rss_after and rss_before else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--batch', type=int, default=1000)
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed growth over the baseline (fraction)')
+    parser.add_argument('--update', action='store_true', help='write the results as the new baseline')
+    args = parser.parse_args()
+
+    result = measure(args.batch)
+    print(json.dumps(result, indent=2))
+
+    if args.update:
+        with open(BASELINE, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
+        print(f"Baseline written to {BASELINE}")
+        return 0
+
+    if not os.path.exists(BASELINE):
+        print('No baseline recorded yet; run with --update')
+        return 1
+    with open(BASELINE) as f:
+        baseline = json.load(f)
+
+    failures = []
+    checks = [('receipt_peak_bytes', result['receipt_peak_bytes'], baseline['receipt_peak_bytes'])]
+    if result['batch_size'] == baseline['batch_size']:
+        checks.append(('batch_peak_bytes', result['batch_peak_bytes'], baseline['batch_peak_bytes']))
+    for name, value, limit in checks:
+        if value > limit * (1 + args.tolerance):
+            failures.append(f"{name}: {value} > {limit} (+{args.tolerance:.0%})")
+    if failures:
+        print('Memory regression:\n  ' + '\n  '.join(failures))
+        return 1
+    print('Memory within baseline')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,77 @@
+"""
+Batch wall-clock time of the staged pipeline against a sequential loop.
+
+Both send to a local SMTP stand-in with the given latency. The sequential
+loop renders receipt N, sends it, then renders N+1; the pipeline overlaps
+rendering and MIME building (CPU, serialized by the GIL) with the SMTP
+waits, so its time should approach max(render + mime, send) rather than
+their sum.
+
+    python benchmarks/bench_pipeline.py --receipts 200 --smtp-latency-ms 100 --send-workers 4
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import common
+from smtp_standin import SMTPStandIn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=200)
+    parser.add_argument('--smtp-latency-ms', type=float, default=100.0)
+    parser.add_argument('--render-workers', type=int, default=1)
+    parser.add_argument('--send-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    standin = SMTPStandIn(latency_ms=args.smtp_latency_ms)
+    host, port = standin.start()
+    os.environ.update(SMTP_SERVER=host, SMTP_PORT=str(port), SMTP_USE_SSL='0', LOG_LEVEL='WARNING')
+    import main
+    import pipeline
+
+    base = common.load_payload()
+    payloads = [common.payload_variant(base, n) for n in range(args.receipts)]
+    main.warmup()
+
+    # The CPU side alone (PDF and MIME), to compare against
+    start = time.perf_counter()
+    for data in payloads:
+        buffer = io.BytesIO()
+        main.generate_pdf(data, buffer)
+        main.serialize_message(main.build_receipt_email(data, data['email'], buffer.getvalue()))
+    render_only = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for data in payloads:
+        buffer = io.BytesIO()
+        main.generate_pdf(data, buffer)
+        msg = main.build_receipt_email(data, data['email'], buffer.getvalue())
+        main.smtp_send(data['email'], main.serialize_message(msg), keepalive=True)
+    main.close_smtp_sessions()
+    sequential = time.perf_counter() - start
+
+    results, stats = pipeline.run_batch(payloads, args.render_workers, args.send_workers)
+    standin.shutdown()
+
+    # Lower bound on the send side: every message's latency spread over the send workers
+    send_only = args.receipts * args.smtp_latency_ms / 1000 / args.send_workers
+    print(json.dumps({
+        'receipts': args.receipts,
+        'render_mime_only_s': round(render_only, 3),
+        'send_only_s': round(send_only, 3),
+        'sequential_s': round(sequential, 3),
+        'pipeline_s': stats['wall_s'],
+        'pipeline_succeeded': stats['succeeded'],
+        'bottleneck': stats['bottleneck'],
+        'stages': stats['stages'],
+    }, indent=2))
+    return 0 if stats['succeeded'] == args.receipts else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+Interactive latency while a bulk batch runs, with and without the scheduler.
+
+Three phases against a local SMTP stand-in, each --duration seconds of
+open-loop interactive requests through lambda_handler:
+
+    idle        no bulk work (the reference)
+    bulk-fifo   a pipeline batch running, every pool large enough that
+                nothing ever queues (the behaviour before the scheduler)
+    bulk-sched  the same batch with the configured slots, reservations
+                and weights
+
+Interactive p99 in bulk-sched should stay close to idle; bulk throughput
+is reported alongside so the cost to the batch is visible.
+
+    python benchmarks/bench_scheduler.py --rate 10 --duration 20 --smtp-latency-ms 50
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from loadtest import Histogram
+from smtp_standin import SMTPStandIn
+
+
+def run_phase(main, pipeline, scheduler, payloads, args, bulk, pools):
+    for name, (slots, reserved) in pools.items():
+        scheduler.configure(name, slots, reserved)
+
+    stop = threading.Event()
+    bulk_results = []
+
+    def bulk_events():
+        for n in itertools.count():
+            if stop.is_set():
+                return
+            yield payloads[n % len(payloads)]
+
+    bulk_thread = None
+    if bulk:
+        bulk_thread = threading.Thread(
+            target=lambda: bulk_results.append(pipeline.run_batch(bulk_events(), args.render_workers,
+                                                                  args.send_workers)),
+            daemon=True)
+        bulk_thread.start()
+        # Let the batch fill its queues before measuring
+        time.sleep(1.0)
+
+    latency = Histogram()
+    failures = 0
+    failures_lock = threading.Lock()
+
+    def request(data, scheduled):
+        nonlocal failures
+        response = main.lambda_handler(data, None)
+        latency.record(time.perf_counter() - scheduled)
+        if response.get('statusCode') != 200 or not json.loads(response['body'])['email_sent']:
+            with failures_lock:
+                failures += 1
+
+    total = int(args.rate * args.duration)
+    pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    start = time.perf_counter()
+    for n in range(total):
+        scheduled = start + n / args.rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        pool.submit(request, payloads[n % len(payloads)], scheduled)
+    pool.shutdown(wait=True)
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'interactive': {
+            'requests': total,
+            'failures': failures,
+            'percentiles_ms': {str(p): latency.percentile(p) for p in (50, 90, 99)},
+            'max_ms': round(latency.max / 1000, 3),
+        },
+        'scheduler': scheduler.stats(),
+    }
+    if bulk_thread is not None:
+        stop.set()
+        bulk_thread.join()
+        _, stats = bulk_results[0]
+        result['bulk'] = {
+            'receipts': stats['receipts'],
+            'receipts_per_sec': round(stats['receipts'] / stats['wall_s'], 1),
+            'interactive_window_s': round(elapsed, 2),
+        }
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rate', type=float, default=10.0, help='interactive requests per second')
+    parser.add_argument('--duration', type=float, default=20.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--smtp-latency-ms', type=float, default=50.0)
+    parser.add_argument('--render-workers', type=int, default=2)
+    parser.add_argument('--send-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    standin = SMTPStandIn(latency_ms=args.smtp_latency_ms)
+    host, port = standin.start()
+    os.environ.update(SMTP_SERVER=host, SMTP_PORT=str(port), SMTP_USE_SSL='0', LOG_LEVEL='WARNING')
+    import main
+    import pipeline
+    import scheduler
+    main.SMTP_KEEPALIVE = True
+    main.warmup()
+
+    base = common.load_payload()
+    payloads = [common.payload_variant(base, n) for n in range(200)]
+    configured = {
+        'render': (scheduler.RENDER_SLOTS, scheduler.RENDER_RESERVED),
+        'send': (scheduler.SEND_SLOTS, scheduler.SEND_RESERVED),
+    }
+    unbounded = {'render': (10_000, 0), 'send': (10_000, 0)}
+
+    report = {'config': vars(args), 'pools': configured, 'weights': scheduler.WEIGHTS}
+    with common.quiet():
+        report['idle'] = run_phase(main, pipeline, scheduler, payloads, args, False, configured)
+        report['bulk-fifo'] = run_phase(main, pipeline, scheduler, payloads, args, True, unbounded)
+        report['bulk-sched'] = run_phase(main, pipeline, scheduler, payloads, args, True, configured)
+    standin.shutdown()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
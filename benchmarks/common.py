@@ -0,0 +1,47 @@
+"""Helpers shared by the benchmark scripts."""
+import contextlib
+import copy
+import io
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# main.py reads its SMTP settings at import time
+for key, value in {
+    'EMAIL_FROM': 'recibo@localhost',
+    'SMTP_SERVER': 'localhost',
+    'SMTP_PORT': '465',
+    'SMTP_USERNAME': 'bench',
+    'SMTP_PASSWORD': 'bench',
+}.items():
+    os.environ.setdefault(key, value)
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+# generate_pdf looks for the logo relative to the working directory
+os.chdir(ROOT)
+
+
+def load_payload():
+    """Return the sample payload from modelo.json."""
+    with open(os.path.join(ROOT, 'modelo.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def payload_variant(base, n):
+    """Copy of base with unique identifiers for receipt n."""
+    data = copy.deepcopy(base)
+    payment = data['data']['dados_pagamento']
+    payment['id_pagamento'] = f"{payment['id_pagamento'][:-8]}{n:08d}"
+    payment['comprovante'] = f"{payment['comprovante'][:-8]}{n:08d}"
+    payment['valor_pagamento'] = f"{(n % 100000) / 100 + 1:.2f}"
+    return data
+
+
+@contextlib.contextmanager
+def quiet():
+    """Swallow anything the code under test prints to stdout."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
@@ -0,0 +1,245 @@
+"""
+Open-loop load test of lambda_handler, in process, against a local SMTP stand-in.
+
+Arrivals follow a fixed schedule at --rate per second regardless of how fast
+receipts complete, and latency is measured from the scheduled arrival time,
+so queueing delay shows up in the tail instead of being hidden by a slow
+client. Payloads are replayed from a JSON-lines file or derived from
+modelo.json.
+
+    python benchmarks/loadtest.py --rate 20 --duration 60 --concurrency 8 \\
+        --smtp-latency-ms 300 --smtp-failure-rate 0.02 --output result.json
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+from smtp_standin import SMTPStandIn
+
+
+class Histogram:
+    """
+    Log-linear latency histogram in the style of HdrHistogram.
+
+    Values (microseconds) are grouped in power-of-two ranges, each split into
+    sub_buckets linear buckets, which bounds the relative error of any
+    percentile to 1/sub_buckets.
+    """
+
+    def __init__(self, sub_buckets=128):
+        self.sub_buckets = sub_buckets
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def _index(self, value):
+        if value < self.sub_buckets:
+            return (0, int(value))
+        # Values in [sub_buckets << e, sub_buckets << (e + 1)) map to
+        # sub_buckets..2*sub_buckets-1 in range e, buckets 2**e wide
+        exponent = int(math.log2(value / self.sub_buckets))
+        return (exponent, int(value) >> exponent)
+
+    def _lower_bound(self, index):
+        exponent, sub = index
+        return sub << exponent
+
+    def record(self, seconds):
+        value = max(0, int(seconds * 1_000_000))
+        index = self._index(value)
+        with self._lock:
+            self.counts[index] = self.counts.get(index, 0) + 1
+            self.total += 1
+            self.max = max(self.max, value)
+            self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, p):
+        """Value in milliseconds at percentile p (0-100)."""
+        if not self.total:
+            return None
+        target = max(1, math.ceil(self.total * p / 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                exponent, sub = index
+                # Report the bucket's upper edge, capped by the real maximum
+                upper = ((sub + 1) << exponent) - 1
+                return round(min(upper, self.max) / 1000, 3)
+        return round(self.max / 1000, 3)
+
+    def to_dict(self):
+        buckets = [[round(self._lower_bound(i) / 1000, 3), self.counts[i]] for i in sorted(self.counts)]
+        return {
+            'count': self.total,
+            'min_ms': round(self.min / 1000, 3) if self.min is not None else None,
+            'max_ms': round(self.max / 1000, 3),
+            'percentiles_ms': {str(p): self.percentile(p) for p in (50, 75, 90, 95, 99, 99.9, 99.99)},
+            # [bucket lower bound in ms, count] for every non-empty bucket
+            'buckets': buckets,
+        }
+
+
+NAMES = ['JOÃO DA SILVA', 'MARIA CONCEIÇÃO', 'AÇOUGUE SÃO JOSÉ LTDA', 'POLICROM GALVANOTECNICA LTD...',
+         'CAFÉ & CIA ME', 'JOSÉ ÂNGELO GONÇALVES', 'EMPRESA EXEMPLO']
+WORDS = ('pagamento referente nota fiscal serviço prestado competência março '
+         'conforme contrato parcela aluguel manutenção').split()
+
+
+def synthetic_payloads(count, seed=0):
+    """Variants of modelo.json with different names, values and message lengths."""
+    rng = random.Random(seed)
+    base = common.load_payload()
+    payloads = []
+    for n in range(count):
+        data = common.payload_variant(base, n)
+        data['email'] = f"cliente{n}@example.com"
+        payment = data['data']['dados_pagamento']
+        payment['nome_favorecido'] = rng.choice(NAMES)
+        payment['valor_pagamento'] = f"{rng.uniform(1, 50000):.2f}"
+        # Mostly short messages with a long tail that forces paragraph re-wrapping
+        words = int(rng.paretovariate(1.5) * 5)
+        payment['dados_pix_transferencia']['mensagem_ao_recebedor'] = ' '.join(
+            rng.choice(WORDS) for _ in range(min(words, 400)))
+        payloads.append(data)
+    return payloads
+
+
+def replay_payloads(path):
+    """Events or payloads from a JSON-lines file, one per line."""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def classify(response):
+    """error_type for a handler response, or None on full success."""
+    if response.get('statusCode') != 200:
+        return f"HTTP_{response.get('statusCode')}"
+    body = json.loads(response['body'])
+    email_response = body.get('email_response') or {}
+    if body.get('email_recipient') != 'Não fornecido' and not email_response.get('success'):
+        return email_response.get('error_type') or 'EMAIL_FAILED'
+    return None
+
+
+def run(args):
+    standin = SMTPStandIn(latency_ms=args.smtp_latency_ms, jitter_ms=args.smtp_jitter_ms,
+                          failure_rate=args.smtp_failure_rate)
+    host, port = standin.start()
+    os.environ.update(SMTP_SERVER=host, SMTP_PORT=str(port), SMTP_USE_SSL='0')
+    import main
+    if args.smtp_keepalive:
+        main.SMTP_KEEPALIVE = True
+
+    if args.replay:
+        payloads = replay_payloads(args.replay)
+    else:
+        payloads = synthetic_payloads(args.synthetic, args.seed)
+
+    total = args.count or int(args.rate * args.duration)
+    latency = Histogram()
+    service = Histogram()
+    errors = {}
+    errors_lock = threading.Lock()
+
+    def invoke(payload):
+        return main.lambda_handler(payload, None)
+
+    with common.quiet():
+        for n in range(args.warmup):
+            invoke(payloads[n % len(payloads)])
+
+    def job(payload, scheduled):
+        started = time.perf_counter()
+        try:
+            error_type = classify(invoke(payload))
+        except Exception as e:
+            error_type = f"EXCEPTION_{type(e).__name__}"
+        finished = time.perf_counter()
+        latency.record(finished - scheduled)
+        service.record(finished - started)
+        if error_type:
+            with errors_lock:
+                errors[error_type] = errors.get(error_type, 0) + 1
+
+    rng = random.Random(args.seed)
+    pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='loadtest')
+    lag = Histogram()
+    with common.quiet():
+        start = time.perf_counter()
+        scheduled = start
+        for n in range(total):
+            if args.arrival == 'poisson':
+                scheduled += rng.expovariate(args.rate)
+            else:
+                scheduled = start + n / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            lag.record(max(0.0, time.perf_counter() - scheduled))
+            pool.submit(job, payloads[n % len(payloads)], scheduled)
+        pool.shutdown(wait=True)
+        elapsed = time.perf_counter() - start
+    standin.shutdown()
+
+    return {
+        'config': {
+            'rate': args.rate,
+            'arrival': args.arrival,
+            'concurrency': args.concurrency,
+            'requests': total,
+            'payloads': args.replay or f"synthetic:{len(payloads)}",
+            'smtp_latency_ms': args.smtp_latency_ms,
+            'smtp_jitter_ms': args.smtp_jitter_ms,
+            'smtp_failure_rate': args.smtp_failure_rate,
+            'smtp_keepalive': args.smtp_keepalive,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 2),
+        'succeeded': total - sum(errors.values()),
+        'errors': dict(sorted(errors.items())),
+        'latency': latency.to_dict(),
+        'service_time': service.to_dict(),
+        'dispatch_lag': {k: v for k, v in lag.to_dict().items() if k != 'buckets'},
+        'smtp': standin.stats.to_dict(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Open-loop load test of lambda_handler')
+    parser.add_argument('--rate', type=float, default=10.0, help='arrivals per second')
+    parser.add_argument('--arrival', choices=('uniform', 'poisson'), default='poisson')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--count', type=int, help='number of requests (overrides --duration)')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--warmup', type=int, default=3, help='unrecorded requests before the run')
+    parser.add_argument('--replay', help='JSON-lines file of events/payloads to replay')
+    parser.add_argument('--synthetic', type=int, default=500, help='number of synthetic payload variants')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--smtp-latency-ms', type=float, default=0.0)
+    parser.add_argument('--smtp-jitter-ms', type=float, default=0.0)
+    parser.add_argument('--smtp-failure-rate', type=float, default=0.0)
+    parser.add_argument('--smtp-keepalive', action='store_true', help='reuse SMTP sessions')
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    args = parser.parse_args()
+
+    result = run(args)
+    report = json.dumps(result, indent=2, ensure_ascii=False)
+    print(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
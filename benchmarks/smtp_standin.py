@@ -0,0 +1,136 @@
+"""
+Minimal local SMTP server for load tests.
+
+Speaks enough SMTP for smtplib (EHLO, AUTH PLAIN/LOGIN, MAIL, RCPT, DATA,
+RSET, NOOP, QUIT), accepts every message and throws it away. Each message
+waits a configurable latency before the final reply, and a configurable
+fraction is answered with a transient failure. Like a strict MTA, it
+rejects messages with bare LF line endings (RFC 5321 requires CRLF).
+
+    python benchmarks/smtp_standin.py --port 2525 --latency-ms 200 --failure-rate 0.05
+"""
+import argparse
+import random
+import socketserver
+import threading
+import time
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = 0
+        self.failed = 0
+        self.rejected = 0
+        self.sessions = 0
+
+    def add(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def to_dict(self):
+        with self._lock:
+            return {'sessions': self.sessions, 'accepted': self.accepted, 'failed': self.failed,
+                    'rejected': self.rejected}
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        server = self.server
+        server.stats.add('sessions')
+        self.reply('220 localhost recibo SMTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip()
+            verb = command[:4].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+                self.wfile.flush()
+            elif verb == 'AUTH':
+                parts = command.split()
+                if len(parts) >= 2 and parts[1].upper() == 'LOGIN':
+                    if len(parts) == 2:
+                        self.reply('334 VXNlcm5hbWU6')
+                        self.rfile.readline()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.rfile.readline()
+                elif len(parts) == 2:
+                    self.reply('334 ')
+                    self.rfile.readline()
+                self.reply('235 2.7.0 Authentication successful')
+            elif verb in ('MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                bare_lf = False
+                while True:
+                    data = self.rfile.readline()
+                    if not data or data == b'.\r\n':
+                        break
+                    if not data.endswith(b'\r\n') or b'\r' in data[:-2]:
+                        bare_lf = True
+                        # A client sending bare LF may end DATA with one too
+                        if data == b'.\n':
+                            break
+                if not data:
+                    return
+                if bare_lf:
+                    server.stats.add('rejected')
+                    self.reply('550 5.6.0 Bare LF or CR in message (stand-in)')
+                    continue
+                if server.latency:
+                    time.sleep(max(0.0, random.gauss(server.latency, server.jitter)))
+                if random.random() < server.failure_rate:
+                    server.stats.add('failed')
+                    self.reply('451 4.3.0 Temporary failure (stand-in)')
+                else:
+                    server.stats.add('accepted')
+                    self.reply('250 OK queued')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency_ms=0.0, jitter_ms=0.0, failure_rate=0.0):
+        super().__init__(address, SMTPHandler)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.failure_rate = failure_rate
+        self.stats = Stats()
+
+    def start(self):
+        """Serve from a background thread. Returns (host, port)."""
+        threading.Thread(target=self.serve_forever, name='smtp-standin', daemon=True).start()
+        return self.server_address
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local SMTP stand-in for load tests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2525)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    server = SMTPStandIn((args.host, args.port), args.latency_ms, args.jitter_ms, args.failure_rate)
+    print(f"SMTP stand-in listening on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Render thousands of receipts concurrently and check every output.
+
+Each receipt gets a unique comprovante, id_pagamento, valor and name, is
+rendered from a thread pool (through lambda_handler or generate_pdf
+directly), and its PDF text is checked against its own payload, so any
+cross-talk between threads shows up as a mismatch. Needs pypdf
+(pip install pypdf).
+
+    python benchmarks/stress_render.py --receipts 5000 --threads 16
+"""
+import argparse
+import base64
+import io
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import common
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
+
+
+def make_payload(base, n):
+    data = common.payload_variant(base, n)
+    # The handler would otherwise try to send every receipt
+    data.pop('email', None)
+    data['data']['dados_pagamento']['nome_favorecido'] = f"FAVORECIDO {n:06d} AÇÃO"
+    return data
+
+
+def expected_text(data):
+    payment = data['data']['dados_pagamento']
+    return [payment['comprovante'], f"R$ {payment['valor_pagamento']}", payment['nome_favorecido']]
+
+
+def render(main, data, via):
+    if via == 'handler':
+        response = main.lambda_handler(data, None)
+        return base64.b64decode(json.loads(response['body'])['pdf_base64'])
+    buffer = io.BytesIO()
+    main.generate_pdf(data, buffer)
+    return buffer.getvalue()
+
+
+def check(pdf_content, data):
+    """List of problems with one rendered receipt (empty when it matches)."""
+    text = ''.join(page.extract_text() for page in PdfReader(io.BytesIO(pdf_content)).pages)
+    # Long values may be wrapped across lines
+    flat = ''.join(text.split())
+    return [f"missing {value!r}" for value in expected_text(data) if ''.join(value.split()) not in flat]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--receipts', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--via', choices=('handler', 'generate_pdf'), default='handler')
+    args = parser.parse_args()
+    if PdfReader is None:
+        print('pypdf is required: pip install pypdf')
+        return 2
+
+    import main as handler
+
+    base = common.load_payload()
+    payloads = [make_payload(base, n) for n in range(args.receipts)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        outputs = list(pool.map(lambda data: render(handler, data, args.via), payloads))
+    elapsed = time.perf_counter() - start
+
+    failures = {}
+    for n, (data, pdf_content) in enumerate(zip(payloads, outputs)):
+        problems = check(pdf_content, data)
+        if problems:
+            failures[n] = problems
+    print(json.dumps({
+        'receipts': args.receipts,
+        'threads': args.threads,
+        'via': args.via,
+        'elapsed_s': round(elapsed, 2),
+        'receipts_per_sec': round(args.receipts / elapsed, 1),
+        'failures': len(failures),
+        'first_failures': dict(list(failures.items())[:5]),
+    }, indent=2, ensure_ascii=False))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+import contextlib
+import cProfile
+import io
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import logging
+
+from logutil import fields
+
+logger = logging.getLogger('email_service')
+
+# Fraction of invocations to profile (0 disables, 1 profiles every one)
+SAMPLE_RATE = float(os.environ.get('RECIBO_CPUPROFILE_RATE', '0'))
+# With this set, a single invocation can also ask for a profile with
+# "profile": true in the event or an X-Recibo-Profile: 1 header. Off by
+# default: any client could otherwise slow the process down and fill OUTPUT_DIR.
+ALLOW_REQUEST = os.environ.get('RECIBO_CPUPROFILE_ALLOW_REQUEST', '0') == '1'
+# 'cprofile' (deterministic, exact call counts), 'sampler' (statistical,
+# full stacks) or 'both'
+MODE = os.environ.get('RECIBO_CPUPROFILE_MODE', 'both')
+OUTPUT_DIR = os.environ.get('RECIBO_CPUPROFILE_DIR', '/tmp/cpuprofile')
+TOP_N = int(os.environ.get('RECIBO_CPUPROFILE_TOP', '25'))
+INTERVAL = float(os.environ.get('RECIBO_CPUPROFILE_INTERVAL_MS', '1')) / 1000
+# Profiles kept in OUTPUT_DIR; the oldest are deleted beyond this
+MAX_PROFILES = int(os.environ.get('RECIBO_CPUPROFILE_KEEP', '20'))
+
+_PROFILE_SUFFIXES = ('.txt', '.prof', '.collapsed')
+
+_state = threading.local()
+_last_report = None
+
+# Concurrent profiles share the process-wide switch interval: the first one
+# to start lowers it and the last one to finish restores it
+_switch_lock = threading.Lock()
+_switch_users = 0
+_switch_saved = None
+
+
+def requested(event):
+    """Whether this event should be profiled. Cheap enough for every invocation."""
+    if SAMPLE_RATE and (SAMPLE_RATE >= 1 or random.random() < SAMPLE_RATE):
+        return True
+    if not ALLOW_REQUEST or not isinstance(event, dict):
+        return False
+    if event.get('profile') is True:
+        return True
+    headers = event.get('headers')
+    if headers:
+        return (headers.get('X-Recibo-Profile') or headers.get('x-recibo-profile')) == '1'
+    return False
+
+
+def set_key(key):
+    """Name the current profile's output files (e.g. by id_pagamento)."""
+    if getattr(_state, 'active', False) and key:
+        _state.key = key
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class _Sampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval into collapsed-stack counts."""
+
+    def __init__(self, thread_id, base_depth, interval):
+        super().__init__(name='cpuprof-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.base_depth = base_depth
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.reverse()
+            # Drop the frames that were already there when profiling began
+            stack = ';'.join(labels[self.base_depth:])
+            if stack:
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def _lower_switch_interval():
+    global _switch_users, _switch_saved
+    with _switch_lock:
+        if _switch_users == 0:
+            _switch_saved = sys.getswitchinterval()
+            sys.setswitchinterval(min(_switch_saved, INTERVAL))
+        _switch_users += 1
+
+
+def _restore_switch_interval():
+    global _switch_users
+    with _switch_lock:
+        _switch_users -= 1
+        if _switch_users == 0:
+            sys.setswitchinterval(_switch_saved)
+
+
+def _depth(frame):
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+@contextlib.contextmanager
+def invocation(name='invocation'):
+    """
+    Profile everything run inside the block.
+
+    Writes <key>-<timestamp>.collapsed (one "frame;frame;frame count" line per
+    stack, ready for flamegraph.pl or speedscope), <key>-<timestamp>.txt (top
+    TOP_N functions by cumulative time) and <key>-<timestamp>.prof (pstats)
+    to OUTPUT_DIR, and logs the summary. key is the value passed to
+    set_key(), or name.
+    """
+    if getattr(_state, 'active', False):
+        yield
+        return
+    _state.active = True
+    _state.key = name
+
+    profiler = None
+    if MODE in ('cprofile', 'both'):
+        profiler = cProfile.Profile()
+    sampler = None
+    if MODE in ('sampler', 'both'):
+        # The sampler needs the GIL at least once per interval to see the
+        # rendering thread; restored when the profile ends
+        _lower_switch_interval()
+        # Frame 2 is the function that opened the block, seen from inside
+        # contextlib; dropping its callers makes it the root of every stack
+        sampler = _Sampler(threading.get_ident(), _depth(sys._getframe(3)), INTERVAL)
+        sampler.start()
+    started = time.perf_counter()
+    if profiler is not None:
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already attached to this thread
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        elapsed = time.perf_counter() - started
+        if sampler is not None:
+            sampler.stop()
+            _restore_switch_interval()
+        key = _state.key
+        _state.active = False
+        try:
+            _finish(name, key, elapsed, profiler, sampler)
+        except Exception as e:
+            logger.error("Error writing CPU profile: %s", e, exc_info=True)
+
+
+def _finish(name, key, elapsed, profiler, sampler):
+    global _last_report
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    base = os.path.join(OUTPUT_DIR, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', str(key))}-{int(time.time() * 1000)}")
+    report = {
+        'invocation': name,
+        'key': key,
+        'elapsed_ms': round(elapsed * 1000, 2),
+        'files': [],
+    }
+
+    if profiler is not None:
+        summary = io.StringIO()
+        stats = pstats.Stats(profiler, stream=summary)
+        stats.sort_stats('cumulative').print_stats(TOP_N)
+        with open(f"{base}.txt", 'w') as f:
+            f.write(summary.getvalue())
+        stats.dump_stats(f"{base}.prof")
+        report['files'] += [f"{base}.txt", f"{base}.prof"]
+        top = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:TOP_N]
+        report['top'] = [
+            {
+                'function': f"{func} ({os.path.basename(filename)}:{line})",
+                'calls': calls,
+                'tottime_ms': round(tottime * 1000, 3),
+                'cumtime_ms': round(cumtime * 1000, 3),
+            }
+            for (filename, line, func), (_, calls, tottime, cumtime, _) in top
+        ]
+
+    if sampler is not None:
+        with open(f"{base}.collapsed", 'w') as f:
+            for stack, count in sorted(sampler.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        report['files'].append(f"{base}.collapsed")
+        report['samples'] = sampler.samples
+
+    _prune()
+    _last_report = report
+    # The log carries the ten heaviest entries; the files have the rest
+    logger.info("CPU profile", extra=fields(cpu_profile=dict(report, top=report.get('top', [])[:10])))
+
+
+def _prune():
+    """Delete the oldest profiles beyond MAX_PROFILES."""
+    profiles = {}
+    for entry in os.scandir(OUTPUT_DIR):
+        base, ext = os.path.splitext(entry.name)
+        if ext in _PROFILE_SUFFIXES and entry.is_file():
+            files = profiles.setdefault(base, [])
+            files.append(entry)
+    if len(profiles) <= MAX_PROFILES:
+        return
+    by_age = sorted(profiles.values(), key=lambda files: max(entry.stat().st_mtime for entry in files))
+    for files in by_age[:len(profiles) - MAX_PROFILES]:
+        for entry in files:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                # Pruned concurrently by another invocation
+                pass
+
+
+def last_report():
+    """Report of the most recent profiled invocation, or None."""
+    return _last_report
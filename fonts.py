@@ -0,0 +1,289 @@
+import os
+import threading
+import unicodedata
+import logging
+import zlib
+from xml.sax.saxutils import escape
+
+from reportlab.pdfbase import pdfdoc, pdfmetrics
+from reportlab.lib.rl_accel import fp_str
+from reportlab.pdfbase.ttfonts import TTFont, makeToUnicodeCMap
+
+logger = logging.getLogger('email_service')
+
+# Set RECIBO_EMBED_FONTS=0 to force the base-14 Helvetica path
+EMBED_FONTS = os.environ.get('RECIBO_EMBED_FONTS', '1') != '0'
+
+# Directories searched for TrueType files, in order. /opt/fonts is where a
+# Lambda layer with fonts ends up.
+FONT_DIRS = [d for d in (
+    os.environ.get('RECIBO_FONT_DIR'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts'),
+    '/opt/fonts',
+    '/usr/share/fonts/truetype/dejavu',
+    '/usr/share/fonts/dejavu',
+    '/usr/share/fonts/truetype/noto',
+    '/usr/share/fonts/truetype/liberation',
+) if d]
+
+# Candidate families (normal, bold, italic, boldItalic). The first family with
+# regular and bold files is the primary font, with the regular and bold faces
+# standing in for missing italics (fonts-dejavu-core ships no Oblique); the
+# regular face of every other family found joins the fallback chain for
+# glyphs the primary lacks.
+FONT_FAMILIES = [
+    ('DejaVuSans', ('DejaVuSans.ttf', 'DejaVuSans-Bold.ttf',
+                    'DejaVuSans-Oblique.ttf', 'DejaVuSans-BoldOblique.ttf')),
+    ('NotoSans', ('NotoSans-Regular.ttf', 'NotoSans-Bold.ttf',
+                  'NotoSans-Italic.ttf', 'NotoSans-BoldItalic.ttf')),
+    ('LiberationSans', ('LiberationSans-Regular.ttf', 'LiberationSans-Bold.ttf',
+                        'LiberationSans-Italic.ttf', 'LiberationSans-BoldItalic.ttf')),
+]
+
+# Characters every receipt is likely to use. They are assigned to each new
+# document's font subset up front so the subset layout is the same from one
+# receipt to the next and the generated subset can be reused.
+COMMON_CHARS = (
+    ''.join(chr(c) for c in range(32, 127)) +
+    'ÁÀÂÃÉÊÍÓÔÕÚÜÇáàâãéêíóôõúüçºª°§'
+)
+
+# Upper bound on cached subsets per face
+SUBSET_CACHE_SIZE = 64
+
+# Characters the base-14 fonts can draw (WinAnsiEncoding)
+_BASE14_COVERAGE = frozenset(map(ord, bytes(range(32, 256)).decode('cp1252', 'ignore')))
+
+
+class FontFamily:
+    """Font names used by the receipt styles plus the glyph coverage of the regular face."""
+
+    def __init__(self, normal, bold, italic, bold_italic, coverage, embedded):
+        self.normal = normal
+        self.bold = bold
+        self.italic = italic
+        self.bold_italic = bold_italic
+        self.coverage = coverage
+        self.embedded = embedded
+
+
+BASE14_FAMILY = FontFamily('Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique',
+                           'Helvetica-BoldOblique', _BASE14_COVERAGE, False)
+
+_lock = threading.Lock()
+_family = None
+_fallbacks = []          # [(font name, coverage)] tried in order
+_char_fonts = {}         # char -> font name, '' for the primary, None if uncovered
+_embedded_fonts = []     # TTFont objects registered by this module
+
+
+def _find(filename):
+    for directory in FONT_DIRS:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def _cache_subsets(face):
+    """
+    Memoize subset generation and compression on a font face.
+
+    makeSubset and the zlib pass over its output are the bulk of the cost of
+    embedding a font, followed by formatting the subset's Widths array and
+    building its ToUnicode CMap, and with prime_canvas most receipts ask for
+    the same subsets.
+    """
+    make_subset = face.makeSubset
+    add_subset_objects = face.addSubsetObjects
+    char_width = face.getCharWidth
+    cache = {}               # tuple(subset) -> [subset bytes, compressed bytes]
+    cmaps = {}               # (font name, tuple(subset)) -> compressed ToUnicode CMap
+    widths = {}              # code -> width already formatted for the PDF
+    face_lock = threading.Lock()
+
+    def cached_entry(subset):
+        key = tuple(subset)
+        with face_lock:
+            entry = cache.get(key)
+            if entry is None:
+                # TTFontFile keeps a read position, so it must not be shared
+                # between threads while a subset is being built
+                entry = [make_subset(subset), None]
+                if len(cache) >= SUBSET_CACHE_SIZE:
+                    cache.pop(next(iter(cache)))
+                cache[key] = entry
+            return entry
+
+    def cached_make_subset(subset):
+        return cached_entry(subset)[0]
+
+    def cached_char_width(code):
+        # Only TTFont.addObjects asks, to fill the Widths array; bytes are
+        # written to the PDF as they are
+        width = widths.get(code)
+        if width is None:
+            width = widths[code] = fp_str(char_width(code)).encode('ascii')
+        return width
+
+    def cached_add_subset_objects(doc, fontname, subset):
+        ref = add_subset_objects(doc, fontname, subset)
+        if doc.compression:
+            entry = cached_entry(subset)
+            if entry[1] is None:
+                entry[1] = zlib.compress(entry[0])
+            # A stream that already carries a Filter entry is written as is
+            font_file = doc.idToObject['fontFile:%s(%s)' % (face.filename, fontname)]
+            font_file.content = entry[1]
+            font_file.dictionary['Filter'] = pdfdoc.PDFArray([pdfdoc.PDFName('FlateDecode')])
+            # addObjects created this subset's ToUnicode stream just before
+            cmap_stream = doc.idToObject.get('toUnicodeCMap:' + fontname)
+            if cmap_stream is not None:
+                key = (fontname, tuple(subset))
+                compressed = cmaps.get(key)
+                if compressed is None:
+                    compressed = zlib.compress(makeToUnicodeCMap(fontname, subset).encode('latin-1'))
+                    with face_lock:
+                        if len(cmaps) >= SUBSET_CACHE_SIZE:
+                            cmaps.pop(next(iter(cmaps)), None)
+                        cmaps[key] = compressed
+                cmap_stream.content = compressed
+                cmap_stream.dictionary['Filter'] = pdfdoc.PDFArray([pdfdoc.PDFName('FlateDecode')])
+        return ref
+
+    face.makeSubset = cached_make_subset
+    face.getCharWidth = cached_char_width
+    face.addSubsetObjects = cached_add_subset_objects
+
+
+def _register(name, path):
+    font = TTFont(name, path)
+    _cache_subsets(font.face)
+    pdfmetrics.registerFont(font)
+    _embedded_fonts.append(font)
+    return frozenset(font.face.charToGlyph)
+
+
+def _load():
+    """Register the TrueType families found on disk. Called once per process."""
+    family = None
+    fallbacks = []
+    for family_name, files in FONT_FAMILIES:
+        paths = [_find(f) for f in files]
+        try:
+            if family is None and paths[0] and paths[1]:
+                names = [family_name, family_name + '-Bold',
+                         family_name + '-Italic', family_name + '-BoldItalic']
+                coverage = None
+                for index, (name, path) in enumerate(zip(names, paths)):
+                    if path is None:
+                        # Upright face of the same weight
+                        names[index] = names[index - 2]
+                        continue
+                    font_coverage = _register(name, path)
+                    if coverage is None:
+                        coverage = font_coverage
+                pdfmetrics.registerFontFamily(family_name, normal=names[0], bold=names[1],
+                                              italic=names[2], boldItalic=names[3])
+                family = FontFamily(names[0], names[1], names[2], names[3], coverage, True)
+                logger.info("Embedding font family %s from %s", family_name, os.path.dirname(paths[0]))
+            elif paths[0]:
+                fallbacks.append((family_name, _register(family_name, paths[0])))
+        except Exception as e:
+            logger.error("Error registering font %s: %s", family_name, e)
+
+    if family is None:
+        family = BASE14_FAMILY
+    else:
+        # Helvetica is always available as the last resort
+        fallbacks.append((BASE14_FAMILY.normal, BASE14_FAMILY.coverage))
+    return family, fallbacks
+
+
+def get_family():
+    """Return the font family for receipts, registering TrueType fonts on first use."""
+    global _family, _fallbacks
+    if _family is None:
+        with _lock:
+            if _family is None:
+                if EMBED_FONTS:
+                    family, fallbacks = _load()
+                else:
+                    family, fallbacks = BASE14_FAMILY, []
+                _fallbacks = fallbacks
+                _family = family
+    return _family
+
+
+def _font_for(ch, family):
+    """Find the font in the chain that can draw ch."""
+    font = _char_fonts.get(ch, False)
+    if font is False:
+        code = ord(ch)
+        font = None
+        if code in family.coverage:
+            font = ''
+        else:
+            for name, coverage in _fallbacks:
+                if code in coverage:
+                    font = name
+                    break
+        _char_fonts[ch] = font
+    return font
+
+
+def _substitute(ch, family):
+    """Closest drawable character for one no font in the chain covers."""
+    base = ''.join(c for c in unicodedata.normalize('NFKD', ch) if not unicodedata.combining(c))
+    if base and all(ord(c) in family.coverage for c in base):
+        return base
+    return '?'
+
+
+def markup(text):
+    """
+    Escape text for a Paragraph, switching to fallback fonts for missing glyphs.
+
+    Args:
+        text: Value taken from the payload
+
+    Returns:
+        str: Paragraph markup safe to render with the receipt family
+    """
+    text = str(text)
+    family = get_family()
+    coverage = family.coverage
+    # Fast path: the primary font draws the whole string
+    if all(ord(ch) in coverage for ch in text):
+        return escape(text)
+
+    parts = []
+    run_font = ''
+    run = []
+    for ch in text:
+        font = _font_for(ch, family)
+        if font is None:
+            ch = _substitute(ch, family)
+            font = ''
+        if font != run_font:
+            if run:
+                chunk = escape(''.join(run))
+                parts.append(f'<font name="{run_font}">{chunk}</font>' if run_font else chunk)
+            run = []
+            run_font = font
+        run.append(ch)
+    if run:
+        chunk = escape(''.join(run))
+        parts.append(f'<font name="{run_font}">{chunk}</font>' if run_font else chunk)
+    return ''.join(parts)
+
+
+def prime_canvas(canvas, doc):
+    """
+    onFirstPage callback that assigns COMMON_CHARS in every embedded font.
+
+    This gives each document the same subset layout for the common characters,
+    so the subsets cached by makeSubset are reused across receipts.
+    """
+    for font in _embedded_fonts:
+        font.splitString(COMMON_CHARS, canvas._doc)
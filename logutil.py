@@ -0,0 +1,324 @@
+import atexit
+import collections.abc
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+
+# Fraction of invocations whose records at each level are kept. WARNING and
+# above are always kept. Override with e.g. LOG_SAMPLE_RATES="INFO=0.05,DEBUG=0".
+DEFAULT_SAMPLE_RATES = {'DEBUG': 1.0, 'INFO': 1.0}
+
+# Structured fields that never reach the log output as-is
+REDACTED_FIELDS = frozenset(
+    os.environ.get(
+        'LOG_REDACT_FIELDS',
+        'email,recipient,nome_favorecido,cpf_cnpj_favorecido,chave_enderecamento,mensagem_ao_recebedor'
+    ).split(',')
+)
+
+# Addresses inside messages and tracebacks (e.g. the text of an
+# SMTPRecipientsRefused) are masked too while e-mail fields are redacted
+SCRUB_ADDRESSES = bool({'email', 'recipient'} & REDACTED_FIELDS)
+_ADDRESS = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+# Fields bound to the current invocation (request id, payment id, sampling decision)
+_context = contextvars.ContextVar('recibo_log_context', default=None)
+
+_listener = None
+_queue = None
+
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
+
+# Reference point for relativeCreated of lean records
+_started = time.time()
+
+
+def parse_sample_rates(spec):
+    """Parse "INFO=0.1,DEBUG=0" into {'INFO': 0.1, 'DEBUG': 0.0} on top of the defaults."""
+    rates = dict(DEFAULT_SAMPLE_RATES)
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        level, _, rate = item.partition('=')
+        rates[level.strip().upper()] = float(rate)
+    return rates
+
+
+def redact(key, value):
+    """Masked form of a sensitive field value."""
+    if value is None or value == '':
+        return value
+    value = str(value)
+    if key in ('email', 'recipient') and '@' in value:
+        local, _, domain = value.partition('@')
+        return f"{local[:1]}***@{domain}"
+    if key == 'cpf_cnpj_favorecido' and len(value) > 4:
+        return '*' * (len(value) - 4) + value[-4:]
+    return f"[redacted:{len(value)}]"
+
+
+def scrub(text):
+    """text with every e-mail address in it masked as redact() masks a recipient."""
+    if not SCRUB_ADDRESSES or '@' not in text:
+        return text
+    return _ADDRESS.sub(lambda match: redact('email', match.group(0)), text)
+
+
+def fields(**kwargs):
+    """extra= argument carrying structured fields, e.g. logger.info("Sent", extra=fields(recipient=x))."""
+    return {'fields': kwargs}
+
+
+def begin_invocation(sample_rates=None, **bound):
+    """
+    Start the log context for one invocation.
+
+    Decides once whether this invocation's sub-WARNING records are kept, so a
+    sampled invocation is logged completely and the rest only log warnings
+    and errors.
+    """
+    rates = sample_rates or _sample_rates
+    keep = {level: rate >= 1.0 or random.random() < rate for level, rate in rates.items()}
+    _context.set({'keep': keep, 'fields': {k: v for k, v in bound.items() if v is not None}})
+
+
+def bind(**bound):
+    """Add fields to every record of the current invocation."""
+    ctx = _context.get()
+    if ctx is not None:
+        # Replaced rather than updated: queued records keep the fields they were logged with
+        ctx['fields'] = {**ctx['fields'], **{k: v for k, v in bound.items() if v is not None}}
+
+
+def sampled(level):
+    """Whether records at level are kept for the current invocation."""
+    if level >= logging.WARNING:
+        return True
+    ctx = _context.get()
+    keep = ctx['keep'] if ctx is not None else _default_keep
+    return keep.get(logging.getLevelName(level), True)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Drops sub-WARNING records of invocations that were not sampled at that
+    level. Only needed for a stock Logger; ServiceLogger never builds them.
+    """
+
+    def filter(self, record):
+        return sampled(record.levelno)
+
+
+class ContextFilter(logging.Filter):
+    """Attaches the invocation fields to the record (cheap: one dict reference)."""
+
+    def filter(self, record):
+        ctx = _context.get()
+        if ctx is not None:
+            record.context = ctx['fields']
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with sensitive fields redacted."""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': scrub(record.getMessage()),
+        }
+        for source in (getattr(record, 'context', None), getattr(record, 'fields', None)):
+            if source:
+                for key, value in source.items():
+                    entry[key] = redact(key, value) if key in REDACTED_FIELDS else value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exc'] = scrub(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """The original text format, followed by the redacted fields."""
+
+    def __init__(self):
+        super().__init__('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    def format(self, record):
+        # Covers the message and a traceback rendered by LazyQueueHandler
+        return scrub(super().format(record))
+
+    def formatMessage(self, record):
+        # Fields go on the message line, before any traceback
+        line = super().formatMessage(record)
+        extra = {}
+        for source in (getattr(record, 'context', None), getattr(record, 'fields', None)):
+            if source:
+                for key, value in source.items():
+                    extra[key] = redact(key, value) if key in REDACTED_FIELDS else value
+        if extra:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in extra.items())
+        return line
+
+
+class LeanRecord(logging.LogRecord):
+    """
+    LogRecord without the process and multiprocessing details.
+
+    Neither formatter prints them, and looking them up is a visible share of
+    the cost of each record. Otherwise the same attributes as LogRecord.
+    """
+
+    def __init__(self, name, level, pathname, lineno, msg, args, exc_info, func=None, sinfo=None, **kwargs):
+        created = time.time()
+        self.name = name
+        self.msg = msg
+        # logger.info("%(a)s", {'a': 1}), as LogRecord allows
+        if args and len(args) == 1 and isinstance(args[0], collections.abc.Mapping) and args[0]:
+            args = args[0]
+        self.args = args
+        self.levelname = logging.getLevelName(level)
+        self.levelno = level
+        self.pathname = pathname
+        self.filename = os.path.basename(pathname)
+        self.module = os.path.splitext(self.filename)[0]
+        self.exc_info = exc_info
+        self.exc_text = None
+        self.stack_info = sinfo
+        self.lineno = lineno
+        self.funcName = func
+        self.created = created
+        self.msecs = int((created - int(created)) * 1000) + 0.0
+        self.relativeCreated = (created - _started) * 1000
+        self.thread = threading.get_ident()
+        self.threadName = threading.current_thread().name
+        self.processName = None
+        self.process = None
+        self.taskName = None
+
+
+class ServiceLogger(logging.Logger):
+    """
+    Logger that applies sampling before building a record, skips the caller
+    lookup and builds LeanRecords.
+
+    Only the service logger uses it, so other loggers in the process keep
+    the stock behaviour.
+    """
+
+    def isEnabledFor(self, level):
+        # Checked before _log, so a sampled-out record costs a context lookup
+        return sampled(level) and super().isEnabledFor(level)
+
+    def findCaller(self, stack_info=False, stacklevel=1):
+        if stack_info:
+            return super().findCaller(stack_info, stacklevel + 1)
+        # Walking the stack for the caller is the largest per-record cost
+        # logging adds, and no formatter here prints it
+        return '(unknown file)', 0, '(unknown function)', None
+
+    def makeRecord(self, name, level, fn, lno, msg, args, exc_info, func=None, extra=None, sinfo=None):
+        record = LeanRecord(name, level, fn, lno, msg, args, exc_info, func, sinfo)
+        if extra is not None:
+            for key in extra:
+                if key in ('message', 'asctime') or key in record.__dict__:
+                    raise KeyError(f"Attempt to overwrite {key!r} in LogRecord")
+                record.__dict__[key] = extra[key]
+        return record
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves message formatting to the listener thread.
+
+    The stock prepare() renders the message in the calling thread; here only
+    the exception text is rendered eagerly, since a traceback should not
+    outlive the request that raised it.
+    """
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        # Render now if the arguments might change before the listener runs
+        args = record.args
+        if args and not (isinstance(args, tuple) and all(isinstance(a, _IMMUTABLE) for a in args)):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+
+def configure(name='email_service'):
+    """
+    Set up the service logger and return it.
+
+    Sampling is decided in the caller's thread, before a record is built, and
+    kept records are handed to a QueueListener thread, which formats them (LOG_FORMAT=json|text) and
+    writes them to stderr. LOG_ASYNC=0 writes synchronously instead, and
+    LOG_CALLER_INFO=1 keeps the caller details logging collects by default.
+    """
+    global _listener, _queue, _sample_rates, _default_keep
+
+    stop()
+    _sample_rates = parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES'))
+    # Records logged outside an invocation are kept unless their level's rate is 0
+    _default_keep = {level: rate > 0 for level, rate in _sample_rates.items()}
+
+    logger = logging.getLogger(name)
+    # Modules that log through it may have created the logger already, so
+    # its class is switched in place; the logging module's globals and every
+    # other logger are left alone
+    logger.__class__ = logging.Logger if os.environ.get('LOG_CALLER_INFO', '0') == '1' else ServiceLogger
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    formatter = JsonFormatter() if os.environ.get('LOG_FORMAT', 'json') == 'json' else TextFormatter()
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(formatter)
+
+    if os.environ.get('LOG_ASYNC', '1') == '1':
+        _queue = queue.Queue(-1)
+        handler = LazyQueueHandler(_queue)
+        _listener = logging.handlers.QueueListener(_queue, stream_handler, respect_handler_level=False)
+        _listener.start()
+    else:
+        _queue = None
+        handler = stream_handler
+    if not isinstance(logger, ServiceLogger):
+        handler.addFilter(SamplingFilter())
+    handler.addFilter(ContextFilter())
+    logger.addHandler(handler)
+    return logger
+
+
+def flush(timeout=2.0):
+    """Wait until queued records are written (e.g. before a Lambda invocation returns)."""
+    if _queue is None:
+        return
+    deadline = time.monotonic() + timeout
+    while _queue.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.0005)
+
+
+def stop():
+    """Flush and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+_sample_rates = dict(DEFAULT_SAMPLE_RATES)
+_default_keep = {level: True for level in DEFAULT_SAMPLE_RATES}
+
+atexit.register(stop)
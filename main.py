@@ -3,24 +3,43 @@ import os
 import base64
 from datetime import datetime
 import smtplib
+import email.policy
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 from email.mime.image import MIMEImage
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image, HRFlowable
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, HRFlowable, Flowable
+from reportlab.pdfbase import pdfdoc
+from reportlab.lib.utils import ImageReader
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from reportlab.lib.units import inch
 import re
-import logging
+import io
+import tempfile
+import copy
+import hmac
+import time
 import uuid
+import threading
+import fonts
+import logutil
+import memprof
+import cpuprof
+import scheduler
+from outbox import Outbox, OutboxWorker
+from archive import Archive, ArchiveLocked, LOOKUP_KEYS
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, 
-                   format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger('email_service')
+# Configure logging (structured, asynchronous and sampled; see logutil.py)
+logger = logutil.configure('email_service')
+fields = logutil.fields
+
+# Lambda freezes the process between invocations, so queued log records are
+# written out before the handler returns
+LOG_FLUSH_ON_RETURN = os.environ.get(
+    'LOG_FLUSH_ON_RETURN', '1' if 'AWS_LAMBDA_FUNCTION_NAME' in os.environ else '0') == '1'
 
 # Email configuration
 
@@ -29,6 +48,47 @@ SMTP_SERVER = os.environ['SMTP_SERVER']
 SMTP_PORT = int(os.environ['SMTP_PORT'])
 SMTP_USERNAME = os.environ['SMTP_USERNAME']
 SMTP_PASSWORD = os.environ['SMTP_PASSWORD']
+# Plain SMTP is only meant for local stand-ins (see benchmarks/smtp_standin.py)
+SMTP_USE_SSL = os.environ.get('SMTP_USE_SSL', '1') != '0'
+
+# Optional durable outbox. When set, e-mails are queued and delivered by a
+# background worker instead of being sent during the request.
+OUTBOX_PATH = os.environ.get('OUTBOX_PATH')
+
+_outbox = None
+_outbox_worker = None
+_outbox_lock = threading.Lock()
+
+# Optional on-disk archive of rendered receipts, for lookups and re-sends
+# without the original payload
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+
+_archive = None
+_archive_lock = threading.Lock()
+
+# {"lookup": ...} events hand out archived receipts (personal data) without
+# the original payload, so they are off unless enabled and then only served
+# to trusted callers: direct invocations, which IAM already gates, and HTTP
+# requests carrying ARCHIVE_LOOKUP_TOKEN in X-Recibo-Lookup-Token
+ARCHIVE_LOOKUP = os.environ.get('ARCHIVE_LOOKUP', '0') == '1'
+ARCHIVE_LOOKUP_TOKEN = os.environ.get('ARCHIVE_LOOKUP_TOKEN')
+# Re-sends only go to the archived recipient unless this is set
+ARCHIVE_RESEND_ANY_RECIPIENT = os.environ.get('ARCHIVE_RESEND_ANY_RECIPIENT', '0') == '1'
+
+LOGO_PATH = "LOGO COLORIDO FUNDO TRANSPARENTE.png"
+LOGO_WIDTH = 1.5 * inch
+
+# Per-process render caches, filled on first use or by warmup()
+_styles = None
+_styles_lock = threading.Lock()
+_logo = None
+_logo_lock = threading.Lock()
+
+# Reuse authenticated SMTP sessions across messages, from a pool shared by
+# every thread. Enabled by the long-running server (which sizes the pool to
+# its workers); a Lambda invocation opens a fresh session.
+SMTP_KEEPALIVE = os.environ.get('SMTP_KEEPALIVE', '0') == '1'
+SMTP_POOL_SIZE = int(os.environ.get('SMTP_POOL_SIZE', str(scheduler.SEND_SLOTS)))
 
 def parse_datetime(date_str):
     """Parse datetime from the format in the JSON."""
@@ -62,22 +122,18 @@ def parse_datetime(date_str):
     # Return formatted date components for more flexibility
     return day, month_name, year, time
 
-def generate_pdf(data, output_file="/tmp/recibo.pdf"):
-    """Generate a PDF receipt based on the provided data in Itaú style."""
-    print("Starting PDF generation...")
-    
-    # List contents of current directory and /tmp for debugging
-    print("Current directory contents:", os.listdir('.'))
-    print("/tmp directory contents:", os.listdir('/tmp'))
-    
-    doc = SimpleDocTemplate(output_file, pagesize=letter, 
-                            leftMargin=30, rightMargin=30, topMargin=30, bottomMargin=30)
+def _build_styles():
+    """Paragraph styles for the receipt, in the embedded font family when available."""
     styles = getSampleStyleSheet()
     
+    # Registers the embedded TrueType fonts on the first call only
+    family = fonts.get_family()
+    
     # Create custom styles
     title_style = ParagraphStyle(
         'TitleStyle',
         parent=styles['Heading1'],
+        fontName=family.bold,
         alignment=TA_CENTER,
         fontSize=16,
         spaceAfter=6,
@@ -87,6 +143,7 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     header_style = ParagraphStyle(
         'HeaderStyle',
         parent=styles['Heading2'],
+        fontName=family.bold,
         fontSize=10,
         textColor=colors.HexColor('#4a4746'),
         spaceBefore=6,
@@ -96,6 +153,7 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     subheader_style = ParagraphStyle(
         'SubheaderStyle',
         parent=styles['Heading3'],
+        fontName=family.bold,
         fontSize=9,
         textColor=colors.HexColor('#4a4746'),
         spaceBefore=4,
@@ -105,6 +163,7 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     normal_style = ParagraphStyle(
         'NormalStyle',
         parent=styles['Normal'],
+        fontName=family.normal,
         fontSize=9,
         spaceAfter=3,
         textColor=colors.HexColor('#4a4746')
@@ -113,6 +172,7 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     italic_style = ParagraphStyle(
         'ItalicStyle',
         parent=styles['Italic'],
+        fontName=family.italic,
         fontSize=10,
         textColor=colors.HexColor('#4a4746')
     )
@@ -120,6 +180,7 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     important_note_style = ParagraphStyle(
         'ImportantNoteStyle',
         parent=styles['Italic'],
+        fontName=family.italic,
         fontSize=11,
         textColor=colors.HexColor('#4a4746'),
         alignment=TA_CENTER,
@@ -127,6 +188,136 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
         spaceAfter=2
     )
     
+    return {
+        'title': title_style,
+        'header': header_style,
+        'subheader': subheader_style,
+        'normal': normal_style,
+        'italic': italic_style,
+        'important_note': important_note_style,
+    }
+
+def get_styles():
+    """Return the receipt styles, built once per process and shared read-only."""
+    global _styles
+    if _styles is None:
+        with _styles_lock:
+            if _styles is None:
+                _styles = _build_styles()
+    return _styles
+
+def _load_logo():
+    """
+    Read, decode and PDF-encode the logo once.
+    
+    Returns a dict with the raw PNG bytes (for the e-mail), the draw size and
+    the encoded image XObject plus its soft mask, or an empty dict when the
+    logo is missing or unreadable.
+    """
+    if not os.path.exists(LOGO_PATH):
+        return {}
+    try:
+        with open(LOGO_PATH, 'rb') as f:
+            logo_bytes = f.read()
+        image_width, image_height = ImageReader(io.BytesIO(logo_bytes)).getSize()
+        # Same name canvas.drawImage gives a file path, so it finds the
+        # object we register instead of loading the file again
+        name = pdfdoc._digester(f"{LOGO_PATH}auto")
+        xobject = pdfdoc.PDFImageXObject(name, LOGO_PATH, mask='auto')
+        smask = getattr(xobject, '_smask', None)
+        if smask is not None:
+            del xobject._smask
+        return {
+            'bytes': logo_bytes,
+            'name': name,
+            'xobject': xobject,
+            'smask': smask,
+            'width': LOGO_WIDTH,
+            'height': LOGO_WIDTH * image_height / image_width,
+        }
+    except Exception as e:
+        logger.error("Error loading logo: %s", e, exc_info=True)
+        return {}
+
+def _get_logo_data():
+    global _logo
+    if _logo is None:
+        with _logo_lock:
+            if _logo is None:
+                _logo = _load_logo()
+    return _logo
+
+class LogoFlowable(Flowable):
+    """Draws the cached logo; the encoded image is shared by every document."""
+    
+    def __init__(self, logo_data):
+        Flowable.__init__(self)
+        self.logo_data = logo_data
+        self.drawWidth = logo_data['width']
+        self.drawHeight = logo_data['height']
+    
+    def wrap(self, availWidth, availHeight):
+        return self.drawWidth, self.drawHeight
+    
+    def draw(self):
+        canv = self.canv
+        doc = canv._doc
+        name = self.logo_data['name']
+        reg_name = doc.getXObjectName(name)
+        if reg_name not in doc.idToObject:
+            # Register shallow copies (they share the encoded stream), the
+            # same way canvas.drawImage registers a newly loaded image
+            xobject = copy.copy(self.logo_data['xobject'])
+            canv._setXObjects(xobject)
+            doc.Reference(xobject, reg_name)
+            doc.addForm(name, xobject)
+            smask = self.logo_data['smask']
+            if smask is not None:
+                smask = copy.copy(smask)
+                canv._setXObjects(smask)
+                xobject.smask = doc.Reference(smask, doc.getXObjectName(smask.name))
+        canv.drawImage(LOGO_PATH, 0, 0, self.drawWidth, self.drawHeight, mask='auto')
+
+def get_logo():
+    """Return a new logo flowable, or None if the logo is not available."""
+    logo_data = _get_logo_data()
+    if not logo_data:
+        return None
+    return LogoFlowable(logo_data)
+
+def generate_pdf(data, output_file=None):
+    """
+    Generate a PDF receipt based on the provided data in Itaú style.
+    
+    Safe to call from several threads at once: nothing is written outside
+    output_file, and the shared caches (fonts, styles, logo) are read-only
+    once built.
+    
+    Args:
+        data (dict): Receipt payload
+        output_file (str or file-like, optional): Where to write the PDF. A
+            new uniquely named file under the temp directory when omitted.
+    
+    Returns:
+        The path or file object the PDF was written to
+    """
+    logger.debug("Starting PDF generation")
+    
+    if output_file is None:
+        fd, output_file = tempfile.mkstemp(prefix='recibo-', suffix='.pdf')
+        os.close(fd)
+    
+    doc = SimpleDocTemplate(output_file, pagesize=letter, 
+                            leftMargin=30, rightMargin=30, topMargin=30, bottomMargin=30)
+    with memprof.stage('styles'):
+        styles = get_styles()
+        title_style = styles['title']
+        header_style = styles['header']
+        subheader_style = styles['subheader']
+        normal_style = styles['normal']
+        italic_style = styles['italic']
+        important_note_style = styles['important_note']
+    
     # Extract payment data
     payment_data = data['data']['dados_pagamento']
     pix_data = payment_data.get('dados_pix_transferencia', {})
@@ -146,49 +337,15 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     # Content elements
     elements = []
     
-    # Add logo
-    original_logo_path = "LOGO COLORIDO FUNDO TRANSPARENTE.png"
-    tmp_logo_path = "/tmp/logo.png"
-    
-    print(f"Checking for logo at original path: {original_logo_path}")
-    print(f"Original logo exists: {os.path.exists(original_logo_path)}")
-    
-    # Copy logo to /tmp if it exists
-    if os.path.exists(original_logo_path):
-        print("Found logo in original location, copying to /tmp...")
-        try:
-            import shutil
-            shutil.copy2(original_logo_path, tmp_logo_path)
-            print("Logo copied successfully to /tmp")
-        except Exception as e:
-            print(f"Error copying logo to /tmp: {str(e)}")
-    
-    # Try to use the logo from either location
-    logo_path = tmp_logo_path if os.path.exists(tmp_logo_path) else original_logo_path
-    print(f"Using logo path: {logo_path}")
-    print(f"Logo file exists at final path: {os.path.exists(logo_path)}")
-    
-    if os.path.exists(logo_path):
-        try:
-            print("Attempting to create Image object...")
-            # Create Image object with controlled size
-            logo = Image(logo_path)
-            
-            # Set a fixed width
-            desired_width = 1.5 * inch
-            
-            # Calculate height maintaining aspect ratio
-            aspect_ratio = logo.imageHeight / logo.imageWidth
-            desired_height = desired_width * aspect_ratio
-            
-            logo.drawWidth = desired_width
-            logo.drawHeight = desired_height
-            
+    with memprof.stage('logo'):
+        # Add logo (decoded and encoded once per process, see _load_logo)
+        logo = get_logo()
+        if logo is not None:
             # Use horizontal alignment for the logo (Itaú style - logo at left)
             logo_table = Table(
                 [[logo]], 
                 colWidths=[letter[0] - 60],  # full width minus margins
-                rowHeights=[desired_height]
+                rowHeights=[logo.drawHeight]
             )
             logo_table.setStyle(TableStyle([
                 ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
@@ -198,20 +355,12 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
                 ('TOPPADDING', (0, 0), (-1, -1), 0),
                 ('BOTTOMPADDING', (0, 0), (-1, -1), 0),
             ]))
-            
-            print("Logo image object created successfully")
             elements.append(logo_table)
-            print("Logo added to elements list")
             
             # Add more space after the logo
             elements.append(Spacer(1, 0.3 * inch))  # Increased spacing here
-        except Exception as e:
-            print(f"Error adding logo to PDF: {str(e)}")
-            print(f"Error type: {type(e)}")
-            import traceback
-            print(f"Full error traceback: {traceback.format_exc()}")
-    else:
-        print("Logo file not found in any location")
+        else:
+            logger.debug("Logo file not found or unreadable, rendering without it")
     
     # Add document title
     elements.append(Paragraph("COMPROVANTE DE TRANSFERÊNCIA", title_style))
@@ -255,9 +404,9 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     # Create a 2-column table for receiver information (Itaú style)
     receiver_data = [
         [Paragraph("<b>DADOS DO RECEBEDOR</b>", header_style), ""],
-        [Paragraph("<b>Nome:</b>", normal_style), Paragraph(payment_data['nome_favorecido'], normal_style)],
-        [Paragraph("<b>Chave PIX:</b>", normal_style), Paragraph(pix_data.get('chave_enderecamento', ''), normal_style)],
-        [Paragraph("<b>CPF/CNPJ:</b>", normal_style), Paragraph(payment_data['cpf_cnpj_favorecido'], normal_style)]
+        [Paragraph("<b>Nome:</b>", normal_style), Paragraph(fonts.markup(payment_data['nome_favorecido']), normal_style)],
+        [Paragraph("<b>Chave PIX:</b>", normal_style), Paragraph(fonts.markup(pix_data.get('chave_enderecamento', '')), normal_style)],
+        [Paragraph("<b>CPF/CNPJ:</b>", normal_style), Paragraph(fonts.markup(payment_data['cpf_cnpj_favorecido']), normal_style)]
     ]
     
     receiver_table = Table(receiver_data, colWidths=[1.5*inch, 4.0*inch])
@@ -278,22 +427,22 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     # Create a 2-column table for payment details (Itaú style)
     payment_details = [
         [Paragraph("<b>DADOS DO PAGAMENTO</b>", header_style), ""],
-        [Paragraph("<b>Valor:</b>", normal_style), Paragraph(f"R$ {payment_data['valor_pagamento']}", normal_style)],
-        [Paragraph("<b>Data:</b>", normal_style), Paragraph(payment_data['data_pagamento'], normal_style)],
-        [Paragraph("<b>Tipo:</b>", normal_style), Paragraph(payment_data['tipo_pagamento_descricao'], normal_style)]
+        [Paragraph("<b>Valor:</b>", normal_style), Paragraph(fonts.markup(f"R$ {payment_data['valor_pagamento']}"), normal_style)],
+        [Paragraph("<b>Data:</b>", normal_style), Paragraph(fonts.markup(payment_data['data_pagamento']), normal_style)],
+        [Paragraph("<b>Tipo:</b>", normal_style), Paragraph(fonts.markup(payment_data['tipo_pagamento_descricao']), normal_style)]
     ]
     
     # Add company reference if available
     if payment_data.get('referencia_empresa'):
-        payment_details.append([Paragraph("<b>Pagador:</b>", normal_style), Paragraph(payment_data.get('referencia_empresa', ''), normal_style)])
+        payment_details.append([Paragraph("<b>Pagador:</b>", normal_style), Paragraph(fonts.markup(payment_data.get('referencia_empresa', '')), normal_style)])
     
     # Add authorization code if available
     if payment_data.get('comprovante'):
-        payment_details.append([Paragraph("<b>Nº do comprovante:</b>", normal_style), Paragraph(payment_data.get('comprovante', ''), normal_style)])
+        payment_details.append([Paragraph("<b>Nº do comprovante:</b>", normal_style), Paragraph(fonts.markup(payment_data.get('comprovante', '')), normal_style)])
     
     # Add message to receiver here (after comprovante)
     if pix_data.get('mensagem_ao_recebedor'):
-        payment_details.append([Paragraph("<b>Mensagem:</b>", normal_style), Paragraph(pix_data.get('mensagem_ao_recebedor', ''), normal_style)])
+        payment_details.append([Paragraph("<b>Mensagem:</b>", normal_style), Paragraph(fonts.markup(pix_data.get('mensagem_ao_recebedor', '')), normal_style)])
     
     payment_table = Table(payment_details, colWidths=[1.5*inch, 4.0*inch])
     payment_table.setStyle(TableStyle([
@@ -329,19 +478,11 @@ def generate_pdf(data, output_file="/tmp/recibo.pdf"):
     
     elements.append(message_table)
     
-    print("Building final PDF...")
-    # Build the PDF
-    doc.build(elements)
-    print("PDF built successfully")
+    logger.debug("Building final PDF")
+    with memprof.stage('build_pdf'):
+        # Build the PDF
+        doc.build(elements, onFirstPage=fonts.prime_canvas)
     
-    # Clean up the temporary logo file
-    if os.path.exists(tmp_logo_path):
-        try:
-            os.remove(tmp_logo_path)
-            print("Temporary logo file cleaned up")
-        except Exception as e:
-            print(f"Error cleaning up temporary logo: {str(e)}")
-            
     return output_file
 
 def is_valid_email(email):
@@ -371,7 +512,7 @@ def send_email(to_email, subject, body, pdf_content=None):
     # Validate recipient email
     if not is_valid_email(to_email):
         error_msg = f"Invalid email address: {to_email}"
-        logger.error(error_msg)
+        logger.error("Invalid email address", extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -401,11 +542,11 @@ def send_email(to_email, subject, body, pdf_content=None):
 
     # Detailed error handling
     try:
-        logger.info(f"Initiating email send to {to_email} with message ID: {message_id}")
+        logger.debug("Initiating email send", extra=fields(recipient=to_email, message_id=message_id))
         with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=30) as server:
-            logger.info(f"Connected to SMTP server: {SMTP_SERVER}")
+            logger.debug("Connected to SMTP server %s", SMTP_SERVER)
             server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            logger.info("SMTP authentication successful")
+            logger.debug("SMTP authentication successful")
             
             # Send the message
             response = server.send_message(msg)
@@ -413,7 +554,7 @@ def send_email(to_email, subject, body, pdf_content=None):
             # Check if there were any rejected recipients
             if response:
                 rejected_recipients = list(response.keys())
-                logger.error(f"Failed to deliver to some recipients: {rejected_recipients}")
+                logger.error("Failed to deliver to some recipients", extra=fields(recipient=to_email, rejected=len(rejected_recipients)))
                 return {
                     'success': False,
                     'message': f"Email rejected for recipients: {', '.join(rejected_recipients)}",
@@ -422,7 +563,7 @@ def send_email(to_email, subject, body, pdf_content=None):
                     'error_type': 'RECIPIENT_REJECTED'
                 }
             
-            logger.info(f"Email sent successfully to {to_email}")
+            logger.info("Email sent successfully", extra=fields(recipient=to_email, message_id=message_id))
             return {
                 'success': True,
                 'message': "Email sent successfully",
@@ -433,7 +574,7 @@ def send_email(to_email, subject, body, pdf_content=None):
             
     except smtplib.SMTPRecipientsRefused as e:
         error_msg = f"All recipients refused: {str(e)}"
-        logger.error(error_msg)
+        logger.error("All recipients refused: %s", e, extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -444,7 +585,7 @@ def send_email(to_email, subject, body, pdf_content=None):
         
     except smtplib.SMTPAuthenticationError as e:
         error_msg = f"SMTP Authentication Error: {str(e)}"
-        logger.error(error_msg)
+        logger.error("SMTP Authentication Error: %s", e, extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -455,7 +596,7 @@ def send_email(to_email, subject, body, pdf_content=None):
         
     except smtplib.SMTPConnectError as e:
         error_msg = f"SMTP Connection Error: {str(e)}"
-        logger.error(error_msg)
+        logger.error("SMTP Connection Error: %s", e, extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -466,7 +607,7 @@ def send_email(to_email, subject, body, pdf_content=None):
         
     except smtplib.SMTPException as e:
         error_msg = f"SMTP Error: {str(e)}"
-        logger.error(error_msg)
+        logger.error("SMTP Error: %s", e, extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -477,7 +618,7 @@ def send_email(to_email, subject, body, pdf_content=None):
         
     except Exception as e:
         error_msg = f"Unexpected error sending email: {str(e)}"
-        logger.error(error_msg, exc_info=True)
+        logger.error("Unexpected error sending email: %s", e, exc_info=True, extra=fields(recipient=to_email))
         return {
             'success': False,
             'message': error_msg,
@@ -486,254 +627,675 @@ def send_email(to_email, subject, body, pdf_content=None):
             'error_type': 'UNEXPECTED_ERROR'
         }
 
+def build_receipt_email(data, recipient_email, pdf_content):
+    """
+    Build the receipt e-mail with the inline logos and the PDF attached.
+    
+    Args:
+        data (dict): Receipt payload
+        recipient_email (str): Recipient email address
+        pdf_content (bytes): PDF to attach
+        
+    Returns:
+        MIMEMultipart: Message ready to be sent or serialized
+    """
+    # Safely get payment data with defaults
+    payment_data = data.get('data', {}).get('dados_pagamento', {})
+    nome_favorecido = payment_data.get('nome_favorecido', '')
+    valor_pagamento = payment_data.get('valor_pagamento', '')
+    razao_social = payment_data.get('razao_social', '')
+    autorizacao = payment_data.get('autorizacao', '')
+    cpf_cnpj_favorecido = payment_data.get('cpf_cnpj_favorecido', '')
+    referencia_empresa = payment_data.get('referencia_empresa', '')
+    descricao = payment_data.get('descricao', '')
+    
+    # Get PIX data
+    pix_data = payment_data.get('dados_pix_transferencia', {})
+    chave_pix = pix_data.get('chave_enderecamento', '')
+    mensagem_recebedor = pix_data.get('mensagem_ao_recebedor', '')
+    
+    # Create the email message
+    msg = MIMEMultipart('related')
+    msg['From'] = EMAIL_FROM
+    msg['To'] = recipient_email
+    msg['Subject'] = f"Comprovante de Pagamento - {nome_favorecido}"
+    
+    # Add HTML body
+    html_body = f'''
+    <!DOCTYPE html>
+    <html lang="pt-BR">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Comprovante de Pagamento</title>
+    </head>
+    <body style="margin: 0; padding: 0; font-family: Arial, sans-serif; background-color: #f5f5f5;">
+        <table cellpadding="0" cellspacing="0" border="0" width="100%" style="max-width: 600px; margin: 0 auto; background-color: #ffffff;">
+            <!-- Cabeçalho -->
+            <tr>
+                <td style="background-color: #546375; text-align: center; padding: 20px 0;">
+                    <div style="background-color: #ffffff; display: inline-block; padding: 10px; border-radius: 5px;">
+                        <img src="cid:logo" alt="PGW Logo" height="80" style="display: block;">
+                    </div>
+                </td>
+            </tr>
+            
+            <!-- Conteúdo -->
+            <tr>
+                <td style="padding: 30px 40px;">
+                    <h1 style="color: #4a4746; font-size: 22px; margin: 0 0 20px; text-align: center;">Comprovante de Pagamento</h1>
+                    
+                    <p style="margin: 0 0 20px; font-size: 14px; color: #333333; line-height: 1.5;">
+                        Prezado cliente,
+                    </p>
+                    
+                    <p style="margin: 0 0 20px; font-size: 14px; color: #333333; line-height: 1.5;">
+                        O pagamento de <strong style="color: #000;">R$ {valor_pagamento}</strong> solicitado por <strong style="color: #000;">{referencia_empresa}</strong> foi efetivado com sucesso. Seguem as informações do pagamento:
+                    </p>
+                    
+                    <!-- Detalhes do Pagamento -->
+                    <table cellpadding="0" cellspacing="0" border="0" width="100%" style="margin: 20px 0; border-collapse: collapse; border: 1px solid #e0e0e0; border-radius: 4px;">
+                        <tr>
+                            <td style="background-color: #f9f9f9; padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold;" colspan="2">
+                                Detalhes da Transação
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; width: 40%; font-weight: bold; color: #4a4746;">
+                                Recebedor:
+                            </td>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
+                                {nome_favorecido}
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
+                                Chave PIX utilizada:
+                            </td>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
+                                {chave_pix}
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
+                                CPF/CNPJ:
+                            </td>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
+                                {cpf_cnpj_favorecido}
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
+                                Valor:
+                            </td>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #333333;">
+                                R$ {valor_pagamento}
+                            </td>
+                        </tr>
+                        <tr>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
+                                Descrição:
+                            </td>
+                            <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
+                                {mensagem_recebedor}
+                            </td>
+                        </tr>
+                    </table>
+                    
+                    <p style="margin: 25px 0; font-size: 14px; color: #333333; line-height: 1.5; font-style: italic; text-align: center;">
+                        O comprovante de pagamento está anexo a este e-mail.
+                    </p>
+                    
+                    <div style="background-color: #f9f9f9; border: 1px solid #e0e0e0; border-radius: 4px; padding: 15px; margin: 20px 0; text-align: center;">
+                        <p style="margin: 0; font-size: 14px; color: #4a4746; font-style: italic;">
+                            Importante: A PGW Payments utilizou a plataforma do BANCO ITAÚ no processamento desta transação.
+                        </p>
+                    </div>
+                    
+                    <p style="margin: 20px 0 0; font-size: 12px; color: #666666; font-style: italic;">
+                        Este e-mail foi enviado automaticamente pelo sistema de pagamentos PGW. Por favor, não responda a este e-mail.
+                    </p>
+                </td>
+            </tr>
+            
+            <!-- Rodapé -->
+            <tr>
+                <td style="background-color: #f1f1f1; padding: 30px; text-align: center;">
+                    <p style="margin: 0 0 15px; font-size: 14px; color: #333333;">
+                        Caso tenha qualquer dúvida, entre em contato conosco:
+                        <a href="mailto:contato@pgwpay.com.br" style="color: #0066cc; text-decoration: none;">contato@pgwpay.com.br</a>
+                    </p>
+                    
+                    <img src="cid:logo_footer" height="50" style="display: inline-block; margin-bottom: 15px;" alt="PGW Logo">
+                    
+                    <p style="margin: 0 0 5px; font-size: 12px; color: #666666;">
+                        <a href="https://www.pgwpay.com.br" style="color: #0066cc; text-decoration: none;">www.pgwpay.com.br</a>
+                    </p>
+                    
+                    <p style="margin: 0 0 5px; font-size: 12px; color: #666666;">
+                        Rua Aurora, 817 | 8º andar | São Paulo | SP
+                    </p>
+                    
+                    <p style="margin: 0 0 15px; font-size: 12px; color: #666666;">
+                        © 2023 | Todos os direitos reservados a PGW PAYMENTS INTERNET LTDA.<br>
+                        CNPJ: 33.392.629/0001-83
+                    </p>
+                    
+                    <div style="margin-top: 10px;">
+                        <a href="https://www.facebook.com/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/733/733547.png" width="24" alt="Facebook"></a>
+                        <a href="https://www.instagram.com/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/1384/1384063.png" width="24" alt="Instagram"></a>
+                        <a href="https://www.linkedin.com/company/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/3536/3536505.png" width="24" alt="LinkedIn"></a>
+                    </div>
+                </td>
+            </tr>
+        </table>
+    </body>
+    </html>
+    '''
+    
+    html_part = MIMEText(html_body, 'html')
+    msg.attach(html_part)
+    
+    # Attach the logo images (read from disk once per process)
+    logo_bytes = _get_logo_data().get('bytes')
+    if logo_bytes:
+        # Attach header logo
+        img = MIMEImage(logo_bytes, _subtype='png')
+        img.add_header('Content-ID', '<logo>')
+        img.add_header('Content-Disposition', 'inline')
+        msg.attach(img)
+        
+        # Attach footer logo
+        footer_img = MIMEImage(logo_bytes, _subtype='png')
+        footer_img.add_header('Content-ID', '<logo_footer>')
+        footer_img.add_header('Content-Disposition', 'inline')
+        msg.attach(footer_img)
+    
+    # Attach PDF
+    pdf_attachment = MIMEApplication(pdf_content, _subtype='pdf')
+    pdf_attachment.add_header('Content-Disposition', 'attachment', filename='recibo.pdf')
+    msg.attach(pdf_attachment)
+    
+    return msg
+
+# compat32 (how the messages are built) with the CRLF line endings SMTP
+# requires; sendmail() transmits bytes as they are
+SMTP_POLICY = email.policy.compat32.clone(linesep='\r\n')
+
+def serialize_message(msg):
+    """Wire form of msg for smtp_send and the outbox."""
+    return msg.as_bytes(policy=SMTP_POLICY)
+
+def smtp_error_type(error):
+    """Map an exception raised while sending to the error_type values used by send_email."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return 'RECIPIENTS_REFUSED'
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return 'AUTH_ERROR'
+    if isinstance(error, (smtplib.SMTPConnectError, ConnectionError)):
+        return 'CONNECTION_ERROR'
+    if isinstance(error, smtplib.SMTPException):
+        return 'SMTP_ERROR'
+    return 'UNEXPECTED_ERROR'
+
+def _smtp_connect():
+    smtp_class = smtplib.SMTP_SSL if SMTP_USE_SSL else smtplib.SMTP
+    server = smtp_class(SMTP_SERVER, SMTP_PORT, timeout=30)
+    server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    return server
+
+def _smtp_quit(server):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+class SMTPSessionPool:
+    """
+    Authenticated SMTP sessions shared by every thread.
+    
+    At most `size` sessions are open through the pool at once. A send that
+    finds them all busy uses a one-off session instead of waiting, so the
+    pool bounds the sessions held open without limiting concurrent sends
+    (the scheduler's send slots do that).
+    """
+    
+    def __init__(self, size):
+        self.size = max(0, size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._open = 0      # sessions owned by the pool, idle or in use
+    
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+            if self._open < self.size:
+                self._open += 1
+                return None, True
+        return None, False
+    
+    def _checkin(self, server):
+        with self._lock:
+            self._idle.append(server)
+    
+    def _discard(self, server):
+        with self._lock:
+            self._open -= 1
+        if server is not None:
+            server.close()
+    
+    def send(self, recipient_email, message_bytes):
+        server, pooled = self._checkout()
+        if not pooled:
+            with _smtp_connect() as server:
+                server.sendmail(EMAIL_FROM, [recipient_email], message_bytes)
+            return
+        
+        if server is not None:
+            try:
+                server.sendmail(EMAIL_FROM, [recipient_email], message_bytes)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                logger.info("SMTP session dropped, reconnecting")
+                server.close()
+                server = None
+            except BaseException:
+                # Refused recipients and data errors leave the session usable
+                self._checkin(server)
+                raise
+            else:
+                self._checkin(server)
+                return
+        
+        try:
+            server = _smtp_connect()
+        except BaseException:
+            self._discard(None)
+            raise
+        try:
+            server.sendmail(EMAIL_FROM, [recipient_email], message_bytes)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self._discard(server)
+            raise
+        except BaseException:
+            self._checkin(server)
+            raise
+        self._checkin(server)
+    
+    def close(self):
+        """Quit the idle sessions. Sessions in use are kept until returned."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for server in idle:
+            _smtp_quit(server)
+        return len(idle)
+
+_smtp_pool = SMTPSessionPool(SMTP_POOL_SIZE)
+
+def configure_smtp_pool(size):
+    """Replace the SMTP session pool with one of `size` sessions, quitting the old one's idle sessions."""
+    global _smtp_pool
+    old, _smtp_pool = _smtp_pool, SMTPSessionPool(size)
+    old.close()
+    return _smtp_pool
+
+def smtp_send(recipient_email, message_bytes, keepalive=None):
+    """
+    Send a message already serialized by serialize_message().
+    
+    With SMTP_KEEPALIVE (or keepalive=True) the session comes from the shared
+    pool and goes back to it afterwards; a pooled session the server dropped
+    is replaced once.
+    """
+    if not (SMTP_KEEPALIVE if keepalive is None else keepalive):
+        with _smtp_connect() as server:
+            server.sendmail(EMAIL_FROM, [recipient_email], message_bytes)
+        return
+    _smtp_pool.send(recipient_email, message_bytes)
+
+def close_smtp_sessions():
+    """Quit the pooled SMTP sessions that are not in use."""
+    return _smtp_pool.close()
+
+def _outbox_send(recipient_email, message_bytes):
+    # Nobody is waiting on a deferred delivery, so it queues behind interactive sends
+    with scheduler.slot('send', scheduler.BULK):
+        smtp_send(recipient_email, message_bytes)
+
+def get_outbox():
+    """Return the process-wide outbox and make sure its worker is running, or None if disabled."""
+    global _outbox, _outbox_worker
+    if not OUTBOX_PATH:
+        return None
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox_worker = OutboxWorker(Outbox(OUTBOX_PATH), _outbox_send)
+                _outbox = _outbox_worker.outbox
+    _outbox_worker.start()
+    return _outbox
+
+def queue_email(recipient_email, msg):
+    """
+    Serialize msg into the outbox and wake the delivery worker.
+    
+    Returns:
+        dict: Status information including the outbox id
+    """
+    outbox = get_outbox()
+    outbox_id = outbox.enqueue(recipient_email, msg['Subject'], serialize_message(msg))
+    _outbox_worker.wake()
+    logger.info("Email queued in outbox", extra=fields(recipient=recipient_email, outbox_id=outbox_id))
+    return {
+        'success': True,
+        'queued': True,
+        'message': "Email queued for delivery",
+        'recipient': recipient_email,
+        'outbox_id': outbox_id
+    }
+
+def get_archive():
+    """Return the process-wide receipt archive, or None if disabled."""
+    global _archive
+    if not ARCHIVE_DIR:
+        return None
+    if _archive is None:
+        with _archive_lock:
+            if _archive is None:
+                try:
+                    _archive = Archive(ARCHIVE_DIR)
+                except ArchiveLocked as e:
+                    # Lookups still work; receipts of this process are not archived
+                    logger.error("%s, opening it read-only", e)
+                    _archive = Archive(ARCHIVE_DIR, readonly=True)
+    return _archive
+
+def archive_receipt(data, pdf_content):
+    """Store a rendered receipt in the archive. Failures are logged, never raised."""
+    archive = get_archive()
+    if archive is None:
+        return None
+    try:
+        return archive.put(data, pdf_content)
+    except Exception as e:
+        logger.error("Error archiving receipt: %s", e, exc_info=True)
+        return None
+
+def lookup_allowed(event):
+    """Whether event may read the archive (see ARCHIVE_LOOKUP)."""
+    if not ARCHIVE_LOOKUP or not isinstance(event, dict):
+        return False
+    # API Gateway and server.py events; anything else is a direct invocation
+    if not any(key in event for key in ('headers', 'httpMethod', 'requestContext', 'routeKey')):
+        return True
+    if not ARCHIVE_LOOKUP_TOKEN:
+        return False
+    token = next((value for name, value in (event.get('headers') or {}).items()
+                  if name.lower() == 'x-recibo-lookup-token'), None)
+    return token is not None and hmac.compare_digest(token.encode('utf-8'), ARCHIVE_LOOKUP_TOKEN.encode('utf-8'))
+
+def lookup_receipt(data, priority=scheduler.INTERACTIVE):
+    """
+    Serve {"lookup": {...}} events from the archive.
+    
+    With comprovante or id_pagamento the newest matching PDF is returned, and
+    with "resend": true it is e-mailed again to the original recipient (or to
+    "email", with ARCHIVE_RESEND_ANY_RECIPIENT). numero_lote alone lists the
+    lote's receipts. Callers check lookup_allowed() first.
+    The re-send takes a 'send' slot of the given scheduler class.
+    
+    Returns:
+        dict: Lambda proxy response
+    """
+    archive = get_archive()
+    if archive is None:
+        return _json_response(404, {'error': 'Arquivo de recibos não configurado (ARCHIVE_DIR)'})
+    keys = {key: data['lookup'][key] for key in LOOKUP_KEYS if data['lookup'].get(key) is not None}
+    if not keys:
+        return _json_response(400, {'error': f"Informe um de: {', '.join(LOOKUP_KEYS)}"})
+    
+    if 'comprovante' not in keys and 'id_pagamento' not in keys:
+        entries = archive.find(**keys)
+        return _json_response(200, {
+            'receipts': [{key: entry[key] for key in ('comprovante', 'id_pagamento', 'numero_lote', 'created_at')}
+                         for entry in entries]
+        })
+    
+    found = archive.get(keys.get('comprovante'), keys.get('id_pagamento'))
+    if found is None:
+        return _json_response(404, {'error': 'Recibo não encontrado'})
+    entry, pdf_view, payload = found
+    
+    email_response = None
+    if data.get('resend'):
+        archived_email = payload.get('email')
+        recipient_email = data.get('email') or archived_email
+        if (not ARCHIVE_RESEND_ANY_RECIPIENT
+                and (recipient_email or '').lower() != (archived_email or '').lower()):
+            return _json_response(403, {'error': 'Reenvio permitido apenas para o destinatário original'})
+        if not is_valid_email(recipient_email):
+            return _json_response(400, {'error': f"Invalid email address: {recipient_email}"})
+        # The MIME encoder needs its own bytes; everything else reads the mapped segment
+        msg = build_receipt_email(payload, recipient_email, bytes(pdf_view))
+        try:
+            if OUTBOX_PATH:
+                email_response = queue_email(recipient_email, msg)
+            else:
+                with scheduler.slot('send', priority):
+                    smtp_send(recipient_email, serialize_message(msg))
+                email_response = {
+                    'success': True,
+                    'message': "Email sent successfully",
+                    'recipient': recipient_email
+                }
+        except Exception as e:
+            logger.error("Error re-sending email: %s", e, exc_info=True,
+                         extra=fields(recipient=recipient_email, error_type=smtp_error_type(e)))
+            email_response = {
+                'success': False,
+                'message': f"Error sending email: {str(e)}",
+                'recipient': recipient_email,
+                'error_type': smtp_error_type(e)
+            }
+    
+    return _json_response(200, {
+        'comprovante': entry['comprovante'],
+        'id_pagamento': entry['id_pagamento'],
+        'numero_lote': entry['numero_lote'],
+        'archived_at': entry['created_at'],
+        'email_response': email_response,
+        'pdf_base64': base64.b64encode(pdf_view).decode('ascii')
+    })
+
+def _json_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': {
+            'Content-Type': 'application/json'
+        },
+        'body': json.dumps(body)
+    }
+
+# Receipt rendered by warmup(); never sent anywhere
+_WARMUP_PAYLOAD = {
+    "email": "warmup@example.com",
+    "data": {
+        "dados_pagamento": {
+            "id_pagamento": "00000000-0000-0000-0000-000000000000",
+            "cpf_cnpj_favorecido": "00000000000000",
+            "nome_favorecido": "AQUECIMENTO ÇÃÉÍÓÚ",
+            "valor_pagamento": "0.00",
+            "numero_lote": "0",
+            "referencia_empresa": "WARMUP",
+            "data_pagamento": "2025-01-01",
+            "comprovante": "0" * 50,
+            "tipo_pagamento_descricao": "PIX Transferências",
+            "dados_pix_transferencia": {
+                "chave_enderecamento": "00000000000000",
+                "mensagem_ao_recebedor": "Mensagem de aquecimento com acentuação"
+            }
+        },
+        "historico_pagamento": [
+            {"status": "Efetivação", "data": "2025-01-01-00.00.00.000000", "cod_operador": "0"}
+        ]
+    }
+}
+
+def warmup():
+    """
+    Prime every per-process cache so the first real receipt runs warm.
+    
+    Registers the fonts, builds the styles, decodes and encodes the logo,
+    renders a throwaway receipt in memory and builds and serializes a dummy
+    e-mail. Nothing is written to disk or sent, and no network connection is
+    opened, so it is safe to run before a snapshot is taken.
+    
+    Returns:
+        dict: Time spent, in milliseconds
+    """
+    started = time.perf_counter()
+    get_styles()
+    _get_logo_data()
+    buffer = io.BytesIO()
+    generate_pdf(_WARMUP_PAYLOAD, buffer)
+    pdf_content = buffer.getvalue()
+    base64.b64encode(pdf_content)
+    msg = build_receipt_email(_WARMUP_PAYLOAD, _WARMUP_PAYLOAD['email'], pdf_content)
+    serialize_message(msg)
+    json.dumps({'pdf_base64': '', 'email_response': {'success': True}})
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 2)
+    logger.info("Warmup completed in %s ms", elapsed_ms)
+    return {'elapsed_ms': elapsed_ms}
+
+def parse_event(event):
+    """Return the receipt payload of an API Gateway or direct invocation event."""
+    # Check if the event contains a body
+    if 'body' in event:
+        # If the body is a string (from API Gateway), parse it
+        if isinstance(event['body'], str):
+            return json.loads(event['body'])
+        return event['body']
+    # If no body, assume the event itself is the JSON data
+    return event
+
 def lambda_handler(event, context):
     """AWS Lambda function handler"""
+    logutil.begin_invocation(request_id=getattr(context, 'aws_request_id', None))
+    try:
+        with memprof.invocation('lambda_handler'):
+            if cpuprof.requested(event):
+                with cpuprof.invocation('lambda_handler'):
+                    return _handle_event(event, context)
+            return _handle_event(event, context)
+    finally:
+        if LOG_FLUSH_ON_RETURN:
+            logutil.flush()
+
+def _handle_event(event, context):
+    """Render the receipt for one event and send or queue the e-mail."""
+    started = time.perf_counter()
     try:
-        logger.info("Lambda function started")
-        logger.info(f"Event received: {json.dumps(event)}")
+        logger.debug("Lambda function started")
+        with memprof.stage('parse_event'):
+            # Only the shape of the event; its contents are personal data
+            logger.debug("Event received", extra=fields(
+                event_keys=sorted(event) if isinstance(event, dict) else None,
+                body_chars=len(event['body']) if isinstance(event, dict) and isinstance(event.get('body'), str) else None))
+            
+            data = parse_event(event)
         
-        # Check if the event contains a body
-        if 'body' in event:
-            # If the body is a string (from API Gateway), parse it
-            if isinstance(event['body'], str):
-                data = json.loads(event['body'])
-            else:
-                data = event['body']
-        else:
-            # If no body, assume the event itself is the JSON data
-            data = event
+        # {"warmup": true} only primes the caches (e.g. from a scheduled ping)
+        if data.get('warmup') is True:
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json'
+                },
+                'body': json.dumps({'warmup': True, **warmup()})
+            }
+        
+        # Interactive unless the caller marked the request as bulk work
+        priority = scheduler.classify(event, data)
+        
+        # {"lookup": {...}} serves an archived receipt instead of rendering one
+        if isinstance(data.get('lookup'), dict):
+            if not lookup_allowed(event):
+                logger.warning("Archive lookup refused")
+                return _json_response(403, {'error': 'Consulta ao arquivo não permitida'})
+            return lookup_receipt(data, priority)
+        
+        # {"receipts": [...]} renders and sends a whole batch through the staged pipeline
+        if isinstance(data.get('receipts'), list):
+            # Imported here because pipeline imports this module
+            import pipeline
+            results, stats = pipeline.run_batch(data['receipts'])
+            return {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json'
+                },
+                'body': json.dumps({'batch': True, 'stats': stats, 'results': results})
+            }
         
-        logger.info(f"Processing data for email: {data.get('email')}")
+        payment_id = (data.get('data') or {}).get('dados_pagamento', {}).get('id_pagamento')
+        logutil.bind(id_pagamento=payment_id)
+        cpuprof.set_key(payment_id)
+        logger.debug("Processing data", extra=fields(email=data.get('email')))
         
         # Generate the PDF
-        logger.info("Generating PDF...")
-        pdf_path = generate_pdf(data)
-        logger.info(f"PDF generated at: {pdf_path}")
+        with memprof.stage('generate_pdf'):
+            # Rendered in memory, so concurrent invocations share no files
+            pdf_buffer = io.BytesIO()
+            with scheduler.slot('render', priority):
+                generate_pdf(data, pdf_buffer)
+            pdf_content = pdf_buffer.getvalue()
         
-        # Read the PDF file and encode it as base64 for the response
-        logger.info("Reading PDF file for base64 encoding...")
-        with open(pdf_path, 'rb') as pdf_file:
-            pdf_content = pdf_file.read()
+        # Encode the PDF as base64 for the response
+        with memprof.stage('encode_pdf'):
             pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
         
+        # Keep a copy for later lookups and re-sends
+        if ARCHIVE_DIR:
+            with memprof.stage('archive'):
+                archive_receipt(data, pdf_content)
+        
         # Get email from the data
         recipient_email = data.get('email')
         
         # Send email with PDF attachment if email is provided
         email_response = None
         if recipient_email:
-            logger.info(f"Preparing to send email to: {recipient_email}")
-            # Create a temporary copy of the PDF for email
-            temp_pdf_path = "/tmp/email_recibo.pdf"
-            with open(temp_pdf_path, 'wb') as temp_file:
-                temp_file.write(pdf_content)
-            
-            # Safely get payment data with defaults
-            payment_data = data.get('data', {}).get('dados_pagamento', {})
-            nome_favorecido = payment_data.get('nome_favorecido', '')
-            valor_pagamento = payment_data.get('valor_pagamento', '')
-            razao_social = payment_data.get('razao_social', '')
-            autorizacao = payment_data.get('autorizacao', '')
-            cpf_cnpj_favorecido = payment_data.get('cpf_cnpj_favorecido', '')
-            referencia_empresa = payment_data.get('referencia_empresa', '')
-            descricao = payment_data.get('descricao', '')
-            
-            # Get PIX data
-            pix_data = payment_data.get('dados_pix_transferencia', {})
-            chave_pix = pix_data.get('chave_enderecamento', '')
-            mensagem_recebedor = pix_data.get('mensagem_ao_recebedor', '')
-            
-            # Create the email message
-            msg = MIMEMultipart('related')
-            msg['From'] = EMAIL_FROM
-            msg['To'] = recipient_email
-            msg['Subject'] = f"Comprovante de Pagamento - {nome_favorecido}"
-            
-            # Add HTML body
-            html_body = f'''
-            <!DOCTYPE html>
-            <html lang="pt-BR">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Comprovante de Pagamento</title>
-            </head>
-            <body style="margin: 0; padding: 0; font-family: Arial, sans-serif; background-color: #f5f5f5;">
-                <table cellpadding="0" cellspacing="0" border="0" width="100%" style="max-width: 600px; margin: 0 auto; background-color: #ffffff;">
-                    <!-- Cabeçalho -->
-                    <tr>
-                        <td style="background-color: #546375; text-align: center; padding: 20px 0;">
-                            <div style="background-color: #ffffff; display: inline-block; padding: 10px; border-radius: 5px;">
-                                <img src="cid:logo" alt="PGW Logo" height="80" style="display: block;">
-                            </div>
-                        </td>
-                    </tr>
-                    
-                    <!-- Conteúdo -->
-                    <tr>
-                        <td style="padding: 30px 40px;">
-                            <h1 style="color: #4a4746; font-size: 22px; margin: 0 0 20px; text-align: center;">Comprovante de Pagamento</h1>
-                            
-                            <p style="margin: 0 0 20px; font-size: 14px; color: #333333; line-height: 1.5;">
-                                Prezado cliente,
-                            </p>
-                            
-                            <p style="margin: 0 0 20px; font-size: 14px; color: #333333; line-height: 1.5;">
-                                O pagamento de <strong style="color: #000;">R$ {valor_pagamento}</strong> solicitado por <strong style="color: #000;">{referencia_empresa}</strong> foi efetivado com sucesso. Seguem as informações do pagamento:
-                            </p>
-                            
-                            <!-- Detalhes do Pagamento -->
-                            <table cellpadding="0" cellspacing="0" border="0" width="100%" style="margin: 20px 0; border-collapse: collapse; border: 1px solid #e0e0e0; border-radius: 4px;">
-                                <tr>
-                                    <td style="background-color: #f9f9f9; padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold;" colspan="2">
-                                        Detalhes da Transação
-                                    </td>
-                                </tr>
-                                <tr>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; width: 40%; font-weight: bold; color: #4a4746;">
-                                        Recebedor:
-                                    </td>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
-                                        {nome_favorecido}
-                                    </td>
-                                </tr>
-                                <tr>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
-                                        Chave PIX utilizada:
-                                    </td>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
-                                        {chave_pix}
-                                    </td>
-                                </tr>
-                                <tr>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
-                                        CPF/CNPJ:
-                                    </td>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
-                                        {cpf_cnpj_favorecido}
-                                    </td>
-                                </tr>
-                                <tr>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
-                                        Valor:
-                                    </td>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #333333;">
-                                        R$ {valor_pagamento}
-                                    </td>
-                                </tr>
-                                <tr>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; font-weight: bold; color: #4a4746;">
-                                        Descrição:
-                                    </td>
-                                    <td style="padding: 10px 15px; border-bottom: 1px solid #e0e0e0; color: #333333;">
-                                        {mensagem_recebedor}
-                                    </td>
-                                </tr>
-                            </table>
-                            
-                            <p style="margin: 25px 0; font-size: 14px; color: #333333; line-height: 1.5; font-style: italic; text-align: center;">
-                                O comprovante de pagamento está anexo a este e-mail.
-                            </p>
-                            
-                            <div style="background-color: #f9f9f9; border: 1px solid #e0e0e0; border-radius: 4px; padding: 15px; margin: 20px 0; text-align: center;">
-                                <p style="margin: 0; font-size: 14px; color: #4a4746; font-style: italic;">
-                                    Importante: A PGW Payments utilizou a plataforma do BANCO ITAÚ no processamento desta transação.
-                                </p>
-                            </div>
-                            
-                            <p style="margin: 20px 0 0; font-size: 12px; color: #666666; font-style: italic;">
-                                Este e-mail foi enviado automaticamente pelo sistema de pagamentos PGW. Por favor, não responda a este e-mail.
-                            </p>
-                        </td>
-                    </tr>
-                    
-                    <!-- Rodapé -->
-                    <tr>
-                        <td style="background-color: #f1f1f1; padding: 30px; text-align: center;">
-                            <p style="margin: 0 0 15px; font-size: 14px; color: #333333;">
-                                Caso tenha qualquer dúvida, entre em contato conosco:
-                                <a href="mailto:contato@pgwpay.com.br" style="color: #0066cc; text-decoration: none;">contato@pgwpay.com.br</a>
-                            </p>
-                            
-                            <img src="cid:logo_footer" height="50" style="display: inline-block; margin-bottom: 15px;" alt="PGW Logo">
-                            
-                            <p style="margin: 0 0 5px; font-size: 12px; color: #666666;">
-                                <a href="https://www.pgwpay.com.br" style="color: #0066cc; text-decoration: none;">www.pgwpay.com.br</a>
-                            </p>
-                            
-                            <p style="margin: 0 0 5px; font-size: 12px; color: #666666;">
-                                Rua Aurora, 817 | 8º andar | São Paulo | SP
-                            </p>
-                            
-                            <p style="margin: 0 0 15px; font-size: 12px; color: #666666;">
-                                © 2023 | Todos os direitos reservados a PGW PAYMENTS INTERNET LTDA.<br>
-                                CNPJ: 33.392.629/0001-83
-                            </p>
-                            
-                            <div style="margin-top: 10px;">
-                                <a href="https://www.facebook.com/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/733/733547.png" width="24" alt="Facebook"></a>
-                                <a href="https://www.instagram.com/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/1384/1384063.png" width="24" alt="Instagram"></a>
-                                <a href="https://www.linkedin.com/company/pgwpay" style="display: inline-block; margin: 0 5px;"><img src="https://cdn-icons-png.flaticon.com/32/3536/3536505.png" width="24" alt="LinkedIn"></a>
-                            </div>
-                        </td>
-                    </tr>
-                </table>
-            </body>
-            </html>
-            '''
+            logger.debug("Preparing to send email", extra=fields(recipient=recipient_email))
             
-            html_part = MIMEText(html_body, 'html')
-            msg.attach(html_part)
+            with memprof.stage('build_email'):
+                msg = build_receipt_email(data, recipient_email, pdf_content)
             
-            # Attach the logo images
-            logo_path = "LOGO COLORIDO FUNDO TRANSPARENTE.png"
-            if os.path.exists(logo_path):
-                # Attach header logo
-                with open(logo_path, 'rb') as f:
-                    logo_data = f.read()
-                    img = MIMEImage(logo_data)
-                    img.add_header('Content-ID', '<logo>')
-                    img.add_header('Content-Disposition', 'inline')
-                    msg.attach(img)
-                
-                # Attach footer logo (reading file again)
-                with open(logo_path, 'rb') as f:
-                    logo_data = f.read()
-                    footer_img = MIMEImage(logo_data)
-                    footer_img.add_header('Content-ID', '<logo_footer>')
-                    footer_img.add_header('Content-Disposition', 'inline')
-                    msg.attach(footer_img)
-            
-            # Attach PDF
-            pdf_attachment = MIMEApplication(pdf_content, _subtype='pdf')
-            pdf_attachment.add_header('Content-Disposition', 'attachment', filename='recibo.pdf')
-            msg.attach(pdf_attachment)
-            
-            # Send email
-            try:
-                with smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT) as server:
-                    server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                    server.send_message(msg)
-                email_response = {
-                    'success': True, 
-                    'message': "Email sent successfully",
-                    'recipient': recipient_email
-                }
-                logger.info(f"Email sent successfully to {recipient_email}")
-            except Exception as e:
-                error_msg = f"Error sending email: {str(e)}"
-                logger.error(error_msg, exc_info=True)
-                email_response = {
-                    'success': False, 
-                    'message': error_msg,
-                    'recipient': recipient_email
-                }
-            
-            # Clean up the temporary PDF file
-            if os.path.exists(temp_pdf_path):
-                os.remove(temp_pdf_path)
+            with memprof.stage('send_email'):
+                # Send email, or hand it to the outbox when one is configured
+                try:
+                    if OUTBOX_PATH:
+                        email_response = queue_email(recipient_email, msg)
+                    else:
+                        with scheduler.slot('send', priority):
+                            smtp_send(recipient_email, serialize_message(msg))
+                        email_response = {
+                            'success': True, 
+                            'message': "Email sent successfully",
+                            'recipient': recipient_email
+                        }
+                except Exception as e:
+                    error_msg = f"Error sending email: {str(e)}"
+                    logger.error("Error sending email: %s", e, exc_info=True,
+                                 extra=fields(recipient=recipient_email, error_type=smtp_error_type(e)))
+                    email_response = {
+                        'success': False, 
+                        'message': error_msg,
+                        'recipient': recipient_email,
+                        'error_type': smtp_error_type(e)
+                    }
         else:
-            logger.info("No email provided, skipping email sending")
+            logger.debug("No email provided, skipping email sending")
             email_response = {
                 'success': False,
                 'message': "No recipient email provided", 
@@ -741,26 +1303,35 @@ def lambda_handler(event, context):
             }
         
         # Create response
-        response = {
-            'statusCode': 200,
-            'headers': {
-                'Content-Type': 'application/json'
-            },
-            'body': json.dumps({
-                'message': 'PDF gerado e e-mail enviado com sucesso',
-                'email_sent': email_response and email_response.get('success', False),
-                'email_recipient': recipient_email if recipient_email else 'Não fornecido',
-                'email_response': email_response,
-                'pdf_base64': pdf_base64
-            })
-        }
+        with memprof.stage('build_response'):
+            response = {
+                'statusCode': 200,
+                'headers': {
+                    'Content-Type': 'application/json'
+                },
+                'body': json.dumps({
+                    'message': 'PDF gerado e e-mail enviado com sucesso',
+                    'email_sent': email_response and email_response.get('success', False) and not email_response.get('queued', False),
+                    'email_queued': bool(email_response and email_response.get('queued', False)),
+                    'email_recipient': recipient_email if recipient_email else 'Não fornecido',
+                    'email_response': email_response,
+                    'pdf_base64': pdf_base64
+                })
+            }
         
-        logger.info("Lambda function completed successfully")
+        # One summary record per receipt on the success path
+        logger.info("Receipt processed", extra=fields(
+            recipient=recipient_email,
+            email_sent=bool(email_response.get('success')) and not email_response.get('queued', False),
+            email_queued=bool(email_response.get('queued', False)),
+            pdf_bytes=len(pdf_content),
+            priority=priority,
+            elapsed_ms=round((time.perf_counter() - started) * 1000, 2)))
         return response
         
     except Exception as e:
         error_msg = f"Error in lambda_handler: {str(e)}"
-        logger.error(error_msg, exc_info=True)
+        logger.error("Error in lambda_handler: %s", e, exc_info=True)
         # Return error response
         return {
             'statusCode': 500,
@@ -768,3 +1339,10 @@ def lambda_handler(event, context):
                 'error': error_msg
             })
         }
+
+# Opt-in prewarm during the init phase (also runs before a SnapStart snapshot)
+if os.environ.get('RECIBO_PREWARM', '0') == '1':
+    try:
+        warmup()
+    except Exception as e:
+        logger.error("Warmup failed: %s", e, exc_info=True)
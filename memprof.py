@@ -0,0 +1,147 @@
+import contextlib
+import os
+import threading
+import time
+import tracemalloc
+import logging
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from logutil import fields
+
+logger = logging.getLogger('email_service')
+
+# Set RECIBO_MEMPROFILE=1 to record per-stage allocations. tracemalloc slows
+# allocation-heavy code down noticeably, so it is off by default.
+ENABLED = os.environ.get('RECIBO_MEMPROFILE', '0') == '1'
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+_state = threading.local()
+_last_report = None
+
+
+def current_rss():
+    """Resident set size of this process in bytes, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None if unknown."""
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class _Stage:
+    def __init__(self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.start = 0
+        self.child_peak = 0
+
+    def __enter__(self):
+        # Reserve the slot now so the report lists stages in start order
+        self.record = {'stage': self.name, 'depth': self.depth}
+        _state.stages.append(self.record)
+        self.start = tracemalloc.get_traced_memory()[0]
+        self.rss_start = current_rss()
+        self.started_at = time.perf_counter()
+        stack = _state.stack
+        if len(stack) > 1:
+            # The parent's peak so far would be lost with the reset
+            stack[-2].child_peak = max(stack[-2].child_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, *exc):
+        current, peak = tracemalloc.get_traced_memory()
+        # A nested stage resets the peak counter, so fold its peak back in
+        peak = max(peak, self.child_peak)
+        stack = _state.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_peak = max(stack[-1].child_peak, peak)
+        rss_end = current_rss()
+        self.record.update({
+            'peak_bytes': peak - self.start,
+            'net_bytes': current - self.start,
+            'rss_delta_bytes': rss_end - self.rss_start if rss_end is not None and self.rss_start is not None else None,
+            'elapsed_ms': round((time.perf_counter() - self.started_at) * 1000, 2),
+        })
+        return False
+
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name):
+    """
+    Context manager measuring one stage of the current invocation.
+
+    Returns a shared no-op context manager when profiling is disabled or no
+    invocation is being profiled on this thread.
+    """
+    if not ENABLED:
+        return _NULL_STAGE
+    stack = getattr(_state, 'stack', None)
+    if stack is None:
+        return _NULL_STAGE
+    new_stage = _Stage(name, len(stack))
+    stack.append(new_stage)
+    return new_stage
+
+
+@contextlib.contextmanager
+def invocation(name='invocation'):
+    """
+    Profile everything run inside the block as one invocation.
+
+    The report is logged as JSON and kept for last_report(). Stages opened
+    with stage() inside the block are nested under it. tracemalloc counts the
+    whole process, so numbers are only meaningful when one invocation runs
+    at a time.
+    """
+    if not ENABLED or getattr(_state, 'stack', None) is not None:
+        yield
+        return
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _state.stack = []
+    _state.stages = []
+    try:
+        with stage(name):
+            yield
+    finally:
+        stages = _state.stages
+        _state.stack = None
+        _state.stages = None
+        if started_tracing:
+            tracemalloc.stop()
+        _finish(name, stages)
+
+
+def _finish(name, stages):
+    global _last_report
+    report = {
+        'invocation': name,
+        'peak_bytes': stages[0]['peak_bytes'] if stages else 0,
+        'peak_rss_bytes': peak_rss(),
+        'stages': stages,
+    }
+    _last_report = report
+    logger.info("Memory profile", extra=fields(memory_profile=report))
+
+
+def last_report():
+    """Report of the most recent profiled invocation, or None."""
+    return _last_report
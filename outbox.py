@@ -0,0 +1,300 @@
+import os
+import random
+import sqlite3
+import smtplib
+import threading
+import time
+import logging
+
+from logutil import fields
+
+logger = logging.getLogger('email_service')
+
+# Retry policy for the background worker
+MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+BASE_DELAY = float(os.environ.get('OUTBOX_BASE_DELAY', '5'))      # seconds
+MAX_DELAY = float(os.environ.get('OUTBOX_MAX_DELAY', '900'))      # seconds
+POLL_INTERVAL = float(os.environ.get('OUTBOX_POLL_INTERVAL', '1'))
+# How long a claimed message stays with its worker before another one may
+# take it over (a worker that died mid-batch). Must cover a whole claimed
+# batch of SMTP timeouts.
+LEASE = float(os.environ.get('OUTBOX_LEASE', '900'))      # seconds
+CLAIM_BATCH = int(os.environ.get('OUTBOX_CLAIM_BATCH', '20'))
+
+# Errors that will not go away by trying again
+PERMANENT_ERRORS = (smtplib.SMTPRecipientsRefused,)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    subject TEXT,
+    message BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    last_error TEXT,
+    lease_until REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt);
+"""
+
+
+class Outbox:
+    """
+    Durable queue of serialized e-mails backed by SQLite in WAL mode.
+
+    Rows move from 'pending' to 'sending' when a worker claims them, then to
+    'sent' or 'failed' (or back to 'pending' for a retry). Claims are taken
+    in one write transaction, so workers sharing the database never deliver
+    the same message twice; a claim that outlives its lease (the worker died)
+    is handed out again. Every transition is its own transaction, so a crash
+    at any point leaves the message claimable or with its final outcome
+    recorded.
+
+    SQLite WAL needs a local filesystem: keep the database on the host or
+    container volume, not on NFS or EFS.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(outbox)')}
+        if 'lease_until' not in columns:
+            # Databases created before claims existed
+            conn.execute('ALTER TABLE outbox ADD COLUMN lease_until REAL')
+        conn.commit()
+
+    def _conn(self):
+        # One connection per thread; the request path and the worker never
+        # share a cursor
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL + NORMAL survives process crashes; only an OS crash can lose
+            # the last commits, and it keeps enqueue free of fsync waits
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, recipient, subject, message_bytes):
+        """
+        Store a serialized message for delivery.
+
+        Returns:
+            int: Outbox id of the message
+        """
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            cursor = conn.execute(
+                'INSERT INTO outbox (recipient, subject, message, next_attempt, created_at, updated_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (recipient, subject, message_bytes, now, now, now))
+        return cursor.lastrowid
+
+    def claim(self, limit=CLAIM_BATCH, lease=LEASE):
+        """
+        Claim up to limit due messages for this worker.
+
+        Pending messages whose next attempt time has passed, and messages
+        whose previous claim expired, are marked 'sending' until now + lease
+        in a single write transaction, so no other worker gets them.
+        """
+        now = time.time()
+        conn = self._conn()
+        # IMMEDIATE takes the write lock before reading, so two workers
+        # cannot both select the same rows
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            rows = conn.execute(
+                'SELECT id, recipient, message, attempts FROM outbox '
+                'WHERE (status = ? AND next_attempt <= ?) OR (status = ? AND lease_until <= ?) '
+                'ORDER BY next_attempt LIMIT ?',
+                ('pending', now, 'sending', now, limit)).fetchall()
+            conn.executemany(
+                'UPDATE outbox SET status = ?, lease_until = ?, updated_at = ? WHERE id = ?',
+                [('sending', now + lease, now, row[0]) for row in rows])
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        return rows
+
+    def mark_sent(self, message_id):
+        self._finish(message_id, 'sent', None)
+
+    def mark_failed(self, message_id, error):
+        self._finish(message_id, 'failed', error)
+
+    def mark_retry(self, message_id, error, delay):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, next_attempt = ?, last_error = ?, '
+                'lease_until = NULL, updated_at = ? WHERE id = ?',
+                ('pending', now + delay, error, now, message_id))
+
+    def _finish(self, message_id, status, error):
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.execute(
+                'UPDATE outbox SET status = ?, attempts = attempts + 1, last_error = ?, lease_until = NULL, '
+                'updated_at = ? WHERE id = ?',
+                (status, error, now, message_id))
+
+    def get(self, message_id):
+        """Status row of one message as a dict, or None."""
+        row = self._conn().execute(
+            'SELECT id, recipient, subject, status, attempts, next_attempt, last_error '
+            'FROM outbox WHERE id = ?', (message_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'recipient', 'subject', 'status', 'attempts', 'next_attempt', 'last_error')
+        return dict(zip(keys, row))
+
+    def counts(self):
+        """Number of messages per status."""
+        return dict(self._conn().execute('SELECT status, COUNT(*) FROM outbox GROUP BY status').fetchall())
+
+    def pending(self):
+        """Number of messages still waiting for delivery (queued or being sent)."""
+        return self._conn().execute(
+            'SELECT COUNT(*) FROM outbox WHERE status IN (?, ?)', ('pending', 'sending')).fetchone()[0]
+
+
+def backoff_delay(attempts):
+    """Exponential backoff with full jitter for the given number of failed attempts."""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * (2 ** attempts)))
+
+
+class OutboxWorker:
+    """Background thread that drains an Outbox through send_func(recipient, message_bytes)."""
+
+    def __init__(self, outbox, send_func, max_attempts=MAX_ATTEMPTS, poll_interval=POLL_INTERVAL):
+        self.outbox = outbox
+        self.send_func = send_func
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._drain_on_stop = True
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='outbox-worker', daemon=True)
+            self._thread.start()
+        return self
+
+    def wake(self):
+        """Signal that a new message was enqueued."""
+        self._wake.set()
+
+    def stop(self, drain=True, timeout=None):
+        """
+        Stop the worker thread.
+
+        With drain=True, messages that are already due are attempted once more
+        before the thread exits.
+        """
+        self._drain_on_stop = drain
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                processed = self.process_due()
+            except Exception:
+                # A locked or unreadable database must not end the thread;
+                # claimed rows come back once their lease expires
+                logger.error("Outbox worker failed, retrying in %ss", self.poll_interval, exc_info=True)
+                processed = 0
+            if not processed:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+        if self._drain_on_stop:
+            try:
+                self.drain()
+            except Exception:
+                logger.error("Outbox drain failed", exc_info=True)
+
+    def drain(self):
+        """Run process_due() until nothing is due. Returns how many were attempted."""
+        total = 0
+        while True:
+            processed = self.process_due()
+            if not processed:
+                return total
+            total += processed
+
+    def process_due(self):
+        """Claim the due messages and attempt each once. Returns how many were attempted."""
+        rows = self.outbox.claim()
+        for message_id, recipient, message_bytes, attempts in rows:
+            try:
+                self.send_func(recipient, message_bytes)
+            except PERMANENT_ERRORS as e:
+                logger.error("Outbox message %s rejected: %s", message_id, e, extra=fields(recipient=recipient))
+                self.outbox.mark_failed(message_id, str(e))
+            except Exception as e:
+                if attempts + 1 >= self.max_attempts:
+                    logger.error("Outbox message %s failed after %s attempts: %s", message_id, attempts + 1, e,
+                                 extra=fields(recipient=recipient))
+                    self.outbox.mark_failed(message_id, str(e))
+                else:
+                    delay = backoff_delay(attempts)
+                    logger.warning("Outbox message %s failed (attempt %s), retrying in %.1fs: %s",
+                                   message_id, attempts + 1, delay, e, extra=fields(recipient=recipient))
+                    self.outbox.mark_retry(message_id, str(e), delay)
+            else:
+                logger.info("Outbox message %s sent", message_id, extra=fields(recipient=recipient))
+                self.outbox.mark_sent(message_id)
+        return len(rows)
+
+
+def main():
+    """Drain the outbox configured in OUTBOX_PATH once and print the status counts."""
+    import argparse
+    import json
+
+    parser = argparse.ArgumentParser(description='Deliver pending receipt e-mails')
+    parser.add_argument('--path', default=os.environ.get('OUTBOX_PATH'))
+    parser.add_argument('--watch', action='store_true', help='keep running until interrupted')
+    args = parser.parse_args()
+    if not args.path:
+        parser.error('--path or OUTBOX_PATH is required')
+
+    os.environ['OUTBOX_PATH'] = args.path
+    import main as handler
+
+    outbox = Outbox(args.path)
+    worker = OutboxWorker(outbox, handler.smtp_send)
+    if args.watch:
+        worker.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            worker.stop()
+    else:
+        worker.drain()
+    print(json.dumps(outbox.counts()))
+
+
+if __name__ == '__main__':
+    main()
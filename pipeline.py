@@ -0,0 +1,315 @@
+"""
+Staged render/send pipeline for batches of receipts.
+
+    parse -> validate -> render -> mime -> send
+
+Each stage has its own worker threads and a bounded input queue, so the
+next receipts are rendered while earlier ones wait on SMTP and a slow stage
+applies back-pressure instead of piling up PDFs in memory. Batch wall-clock
+time approaches the slowest stage instead of the sum of all of them.
+
+Renders and SMTP sends run as bulk work in the scheduler (scheduler.py),
+so interactive requests served by the same process are not queued behind a
+large batch.
+
+    python pipeline.py payloads.jsonl --send-workers 8
+"""
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import logging
+
+import main
+import scheduler
+from logutil import fields
+
+logger = logging.getLogger('email_service')
+
+# generate_pdf is reentrant, but ReportLab rendering is CPU-bound and runs
+# under the GIL, so one render worker is usually enough; SMTP waits are what
+# extra workers overlap.
+RENDER_WORKERS = int(os.environ.get('PIPELINE_RENDER_WORKERS', '1'))
+SEND_WORKERS = int(os.environ.get('PIPELINE_SEND_WORKERS', '4'))
+# Parsing and validation are cheap; MIME encoding is CPU work like rendering
+PARSE_WORKERS = int(os.environ.get('PIPELINE_PARSE_WORKERS', '1'))
+VALIDATE_WORKERS = int(os.environ.get('PIPELINE_VALIDATE_WORKERS', '1'))
+MIME_WORKERS = int(os.environ.get('PIPELINE_MIME_WORKERS', '1'))
+QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', '8'))
+
+_DONE = object()
+
+
+class Job:
+    """One receipt travelling through the pipeline."""
+
+    def __init__(self, index, event):
+        self.index = index
+        self.event = event
+        self.data = None
+        self.recipient = None
+        self.pdf_content = None
+        self.msg = None
+        self.message_bytes = None
+        self.result = None
+
+
+class JobError(Exception):
+    """Ends a job early with an error_type for its result."""
+
+    def __init__(self, error_type, message):
+        super().__init__(message)
+        self.error_type = error_type
+
+
+class Stage:
+    """A pool of workers applying func to jobs from a bounded queue."""
+
+    def __init__(self, name, func, workers=1, queue_size=QUEUE_SIZE):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.finished = None
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0         # seconds spent in func, summed over workers
+        self.blocked = 0.0      # seconds spent waiting for room downstream
+
+    def start(self):
+        self._running = self.workers
+        for n in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"pipeline-{self.name}-{n}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        try:
+            while True:
+                job = self.queue.get()
+                if job is _DONE:
+                    break
+                started = time.perf_counter()
+                try:
+                    self.func(job)
+                except JobError as e:
+                    job.result = _failure(job, e.error_type, str(e))
+                except Exception as e:
+                    logger.error("Pipeline stage %s failed: %s", self.name, e, exc_info=True,
+                                 extra=fields(recipient=job.recipient))
+                    job.result = _failure(job, 'UNEXPECTED_ERROR', str(e))
+                elapsed = time.perf_counter() - started
+                with self._lock:
+                    self.items += 1
+                    self.busy += elapsed
+                    if job.result is not None and not job.result['success']:
+                        self.errors += 1
+                if job.result is not None or self.next is None:
+                    self.finished(job)
+                else:
+                    started = time.perf_counter()
+                    self.next.queue.put(job)
+                    waited = time.perf_counter() - started
+                    with self._lock:
+                        self.blocked += waited
+        finally:
+            with self._lock:
+                self._running -= 1
+                last = self._running == 0
+            # The last worker out tells every worker of the next stage to stop
+            if last and self.next is not None:
+                for _ in range(self.next.workers):
+                    self.next.queue.put(_DONE)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self, wall):
+        return {
+            'workers': self.workers,
+            'items': self.items,
+            'errors': self.errors,
+            'busy_s': round(self.busy, 3),
+            'blocked_s': round(self.blocked, 3),
+            # Share of the stage's worker time spent doing work
+            'utilization': round(self.busy / (self.workers * wall), 3) if wall else 0.0,
+        }
+
+
+def _failure(job, error_type, message):
+    return {
+        'index': job.index,
+        'success': False,
+        'recipient': job.recipient,
+        'error_type': error_type,
+        'message': message,
+    }
+
+
+def parse(job):
+    try:
+        if isinstance(job.event, str):
+            job.event = json.loads(job.event)
+        job.data = main.parse_event(job.event)
+    except ValueError as e:
+        raise JobError('INVALID_PAYLOAD', f"Invalid JSON body: {str(e)}")
+    job.event = None
+
+
+def validate(job):
+    data = job.data
+    if not isinstance(data, dict) or not isinstance(data.get('data'), dict):
+        raise JobError('INVALID_PAYLOAD', "Missing 'data'")
+    payment_data = data['data'].get('dados_pagamento')
+    if not isinstance(payment_data, dict):
+        raise JobError('INVALID_PAYLOAD', "Missing 'data.dados_pagamento'")
+    missing = [key for key in ('nome_favorecido', 'cpf_cnpj_favorecido', 'valor_pagamento',
+                               'data_pagamento', 'tipo_pagamento_descricao') if key not in payment_data]
+    if missing:
+        raise JobError('INVALID_PAYLOAD', f"Missing fields in dados_pagamento: {', '.join(missing)}")
+    if not isinstance(data['data'].get('historico_pagamento'), list):
+        raise JobError('INVALID_PAYLOAD', "Missing 'data.historico_pagamento'")
+    job.recipient = data.get('email')
+    if not job.recipient:
+        raise JobError('NO_RECIPIENT', "No recipient email provided")
+    if not main.is_valid_email(job.recipient):
+        raise JobError('INVALID_EMAIL', f"Invalid email address: {job.recipient}")
+
+
+def render(job):
+    buffer = io.BytesIO()
+    with scheduler.slot('render', scheduler.BULK):
+        main.generate_pdf(job.data, buffer)
+    job.pdf_content = buffer.getvalue()
+    main.archive_receipt(job.data, job.pdf_content)
+
+
+def build_mime(job):
+    # Encoding the attachment is CPU work too, so it shares the render slots
+    with scheduler.slot('render', scheduler.BULK):
+        job.msg = main.build_receipt_email(job.data, job.recipient, job.pdf_content)
+        if not main.OUTBOX_PATH:
+            job.message_bytes = main.serialize_message(job.msg)
+    job.pdf_content = None
+
+
+def send(job):
+    try:
+        if main.OUTBOX_PATH:
+            job.result = dict(main.queue_email(job.recipient, job.msg), index=job.index, error_type=None)
+        else:
+            # Sessions come from the shared pool and stay open for the batch
+            with scheduler.slot('send', scheduler.BULK):
+                main.smtp_send(job.recipient, job.message_bytes, keepalive=True)
+            job.result = {
+                'index': job.index,
+                'success': True,
+                'recipient': job.recipient,
+                'error_type': None,
+                'message': "Email sent successfully",
+            }
+    except Exception as e:
+        logger.error("Error sending email: %s", e, extra=fields(recipient=job.recipient))
+        raise JobError(main.smtp_error_type(e), f"Error sending email: {str(e)}")
+    finally:
+        job.msg = None
+        job.message_bytes = None
+
+
+def run_batch(events, render_workers=RENDER_WORKERS, send_workers=SEND_WORKERS, queue_size=QUEUE_SIZE,
+              parse_workers=PARSE_WORKERS, validate_workers=VALIDATE_WORKERS, mime_workers=MIME_WORKERS):
+    """
+    Render and send every receipt in events.
+
+    Args:
+        events (iterable): Payloads, Lambda-style events or JSON strings
+        render_workers (int): Threads rendering PDFs
+        send_workers (int): Threads sending (or queueing) e-mails
+        queue_size (int): Capacity of each stage's input queue
+        parse_workers (int): Threads parsing events
+        validate_workers (int): Threads validating payloads
+        mime_workers (int): Threads building and serializing the messages
+
+    Returns:
+        tuple: (results in input order, per-stage statistics)
+    """
+    stages = [
+        Stage('parse', parse, parse_workers, queue_size),
+        Stage('validate', validate, validate_workers, queue_size),
+        Stage('render', render, render_workers, queue_size),
+        Stage('mime', build_mime, mime_workers, queue_size),
+        Stage('send', send, send_workers, queue_size),
+    ]
+    results = []
+    results_lock = threading.Lock()
+
+    def finished(job):
+        with results_lock:
+            results.append(job.result)
+
+    for stage, following in zip(stages, stages[1:] + [None]):
+        stage.next = following
+        stage.finished = finished
+
+    started = time.perf_counter()
+    for stage in stages:
+        stage.start()
+    count = 0
+    for index, event in enumerate(events):
+        stages[0].queue.put(Job(index, event))
+        count += 1
+    for _ in range(stages[0].workers):
+        stages[0].queue.put(_DONE)
+    for stage in stages:
+        stage.join()
+    wall = time.perf_counter() - started
+    if not main.SMTP_KEEPALIVE:
+        # Nothing will reuse the sessions before the next batch
+        main.close_smtp_sessions()
+
+    results.sort(key=lambda result: result['index'])
+    per_stage = {stage.name: stage.stats(wall) for stage in stages}
+    stats = {
+        'receipts': count,
+        'succeeded': sum(1 for result in results if result['success']),
+        'wall_s': round(wall, 3),
+        # The stage whose workers were busiest bounds the batch
+        'bottleneck': max(per_stage, key=lambda name: per_stage[name]['utilization']) if count else None,
+        'stages': per_stage,
+    }
+    logger.info("Batch processed", extra=fields(
+        receipts=count, succeeded=stats['succeeded'], wall_s=stats['wall_s'], bottleneck=stats['bottleneck']))
+    return results, stats
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Render and send a batch of receipts')
+    parser.add_argument('path', help='JSON-lines file of events or payloads (- for stdin)')
+    parser.add_argument('--parse-workers', type=int, default=PARSE_WORKERS)
+    parser.add_argument('--validate-workers', type=int, default=VALIDATE_WORKERS)
+    parser.add_argument('--render-workers', type=int, default=RENDER_WORKERS)
+    parser.add_argument('--mime-workers', type=int, default=MIME_WORKERS)
+    parser.add_argument('--send-workers', type=int, default=SEND_WORKERS)
+    parser.add_argument('--queue-size', type=int, default=QUEUE_SIZE)
+    args = parser.parse_args()
+
+    source = sys.stdin if args.path == '-' else open(args.path, encoding='utf-8')
+    with source:
+        lines = (line for line in source if line.strip())
+        results, stats = run_batch(lines, args.render_workers, args.send_workers, args.queue_size,
+                                   args.parse_workers, args.validate_workers, args.mime_workers)
+    print(json.dumps({'stats': stats, 'results': results}, indent=2, ensure_ascii=False))
+    return 0 if stats['succeeded'] == stats['receipts'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,269 @@
+"""
+Priority-aware admission in front of the render and send workers.
+
+Every unit of work names a resource ('render' or 'send') and a class:
+
+    interactive  a caller is waiting on the response (one API request)
+    bulk         batches, re-issues and deferred outbox deliveries
+
+Each resource has a fixed number of slots. Free slots are granted at once;
+when they run out, waiting work is granted by weighted fair queuing between
+the classes (WEIGHTS, FIFO within a class), and the last RESERVED slots of
+a resource are never given to bulk work, so an interactive request still
+finds one even while a large batch keeps every bulk slot busy.
+
+    with scheduler.slot('render', scheduler.BULK):
+        generate_pdf(data, buffer)
+
+Per-class queue depth, slots in use and wait times are exported on the
+server's /metrics.
+"""
+import bisect
+import collections
+import contextlib
+import os
+import threading
+import time
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+CLASSES = (INTERACTIVE, BULK)
+
+
+def parse_weights(spec):
+    """
+    Parse "interactive=4,bulk=1" into {'interactive': 4.0, 'bulk': 1.0}.
+
+    Raises ValueError for a weight that is not a positive number: a class
+    with weight 0 would never advance in the fair queue.
+    """
+    weights = {INTERACTIVE: 4.0, BULK: 1.0}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, _, weight = item.partition('=')
+        name = name.strip().lower()
+        value = float(weight)
+        if not value > 0:
+            raise ValueError(f"Scheduler weight for {name!r} must be greater than 0, got {weight.strip()!r}")
+        weights[name] = value
+    return weights
+
+
+# Share of the grants each class gets while both have work waiting
+WEIGHTS = parse_weights(os.environ.get('SCHED_WEIGHTS'))
+# ReportLab renders under the GIL, so extra render slots add little
+# throughput; the reserved one keeps a bulk render from delaying an
+# interactive request by more than the GIL share it takes.
+RENDER_SLOTS = int(os.environ.get('SCHED_RENDER_SLOTS', '2'))
+RENDER_RESERVED = int(os.environ.get('SCHED_RENDER_RESERVED', '1'))
+# SMTP sends mostly wait on the network, so they get more slots
+SEND_SLOTS = int(os.environ.get('SCHED_SEND_SLOTS', '8'))
+SEND_RESERVED = int(os.environ.get('SCHED_SEND_RESERVED', '2'))
+
+# Upper bounds (seconds) of the wait-time histogram buckets
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Waiter:
+    __slots__ = ('enqueued', 'event')
+
+    def __init__(self):
+        self.enqueued = time.perf_counter()
+        self.event = threading.Event()
+
+
+class _ClassState:
+    """Queue, virtual time and wait statistics of one class on one resource."""
+
+    def __init__(self, name, weight, limit):
+        self.name = name
+        self.weight = weight
+        self.limit = limit
+        self.waiting = collections.deque()
+        self.in_use = 0
+        self.vtime = 0.0
+        self.granted = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.buckets = [0] * (len(WAIT_BUCKETS) + 1)
+
+
+class Resource:
+    """
+    A pool of slots shared by the priority classes.
+
+    Args:
+        name (str): Label used in metrics
+        slots (int): Units of work running at once
+        reserved (int): Slots only interactive work may take (at least one
+            slot is always left to bulk work)
+        weights (dict): Class name -> weight for fair queuing
+    """
+
+    def __init__(self, name, slots, reserved=0, weights=None):
+        weights = weights or WEIGHTS
+        self.name = name
+        self.slots = max(1, slots)
+        self.reserved = max(0, min(reserved, self.slots - 1))
+        self._lock = threading.Lock()
+        self._in_use = 0
+        # Virtual time of the last grant; a class that was idle starts from
+        # here instead of cashing in the turns it did not use
+        self._vclock = 0.0
+        self._classes = {
+            name: _ClassState(name, weights.get(name, 1.0),
+                              self.slots if name == INTERACTIVE else self.slots - self.reserved)
+            for name in CLASSES
+        }
+
+    def acquire(self, priority=INTERACTIVE):
+        state = self._classes[priority]
+        with self._lock:
+            if not state.waiting and self._in_use < self.slots and state.in_use < state.limit:
+                self._grant(state, 0.0)
+                return
+            waiter = _Waiter()
+            state.waiting.append(waiter)
+        waiter.event.wait()
+
+    def release(self, priority=INTERACTIVE):
+        state = self._classes[priority]
+        with self._lock:
+            state.in_use -= 1
+            self._in_use -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        now = time.perf_counter()
+        while self._in_use < self.slots:
+            eligible = [state for state in self._classes.values()
+                        if state.waiting and state.in_use < state.limit]
+            if not eligible:
+                return
+            state = min(eligible, key=lambda state: max(state.vtime, self._vclock))
+            waiter = state.waiting.popleft()
+            self._grant(state, now - waiter.enqueued)
+            waiter.event.set()
+
+    def _grant(self, state, waited):
+        # Start-time fair queuing: each grant advances the class's virtual
+        # time by 1/weight, and the lowest start time goes next
+        start = max(state.vtime, self._vclock)
+        state.vtime = start + 1.0 / state.weight
+        self._vclock = start
+        state.in_use += 1
+        self._in_use += 1
+        state.granted += 1
+        state.wait_sum += waited
+        state.wait_max = max(state.wait_max, waited)
+        state.buckets[bisect.bisect_left(WAIT_BUCKETS, waited)] += 1
+
+    def stats(self):
+        with self._lock:
+            classes = {}
+            for state in self._classes.values():
+                classes[state.name] = {
+                    'queued': len(state.waiting),
+                    'in_use': state.in_use,
+                    'limit': state.limit,
+                    'weight': state.weight,
+                    'granted': state.granted,
+                    'wait_avg_ms': round(state.wait_sum / state.granted * 1000, 3) if state.granted else 0.0,
+                    'wait_max_ms': round(state.wait_max * 1000, 3),
+                    'buckets': list(state.buckets),
+                    'wait_sum': state.wait_sum,
+                }
+            return {'slots': self.slots, 'reserved': self.reserved, 'in_use': self._in_use, 'classes': classes}
+
+
+_resources = {}
+_resources_lock = threading.Lock()
+
+
+def configure(name, slots, reserved=0, weights=None):
+    """Replace a resource's pool. Work already holding a slot releases it on the old pool."""
+    with _resources_lock:
+        _resources[name] = Resource(name, slots, reserved, weights)
+    return _resources[name]
+
+
+def get(name):
+    return _resources[name]
+
+
+configure('render', RENDER_SLOTS, RENDER_RESERVED)
+configure('send', SEND_SLOTS, SEND_RESERVED)
+
+
+@contextlib.contextmanager
+def slot(resource, priority=INTERACTIVE):
+    """Hold one slot of resource for the duration of the block."""
+    pool = _resources[resource]
+    pool.acquire(priority)
+    try:
+        yield
+    finally:
+        pool.release(priority)
+
+
+def classify(event, data=None):
+    """
+    Priority class of one invocation: bulk when the payload has
+    "priority": "bulk" or the request an X-Recibo-Priority: bulk header,
+    interactive otherwise.
+    """
+    if isinstance(data, dict) and data.get('priority') == BULK:
+        return BULK
+    if not isinstance(event, dict):
+        return INTERACTIVE
+    if event.get('priority') == BULK:
+        return BULK
+    headers = event.get('headers')
+    if headers:
+        value = headers.get('X-Recibo-Priority') or headers.get('x-recibo-priority')
+        if value and value.strip().lower() == BULK:
+            return BULK
+    return INTERACTIVE
+
+
+def stats():
+    """Per-resource, per-class scheduler statistics."""
+    with _resources_lock:
+        pools = list(_resources.values())
+    result = {}
+    for pool in pools:
+        pool_stats = pool.stats()
+        for class_stats in pool_stats['classes'].values():
+            del class_stats['buckets'], class_stats['wait_sum']
+        result[pool.name] = pool_stats
+    return result
+
+
+def render_metrics():
+    """Scheduler gauges and the wait-time histogram in Prometheus text format."""
+    with _resources_lock:
+        pools = list(_resources.values())
+    snapshots = [(pool.name, pool.stats()) for pool in pools]
+    lines = ['# TYPE recibo_scheduler_slots gauge']
+    for name, snapshot in snapshots:
+        lines.append(f'recibo_scheduler_slots{{resource="{name}"}} {snapshot["slots"]}')
+    lines.append('# TYPE recibo_scheduler_reserved_slots gauge')
+    for name, snapshot in snapshots:
+        lines.append(f'recibo_scheduler_reserved_slots{{resource="{name}"}} {snapshot["reserved"]}')
+    for metric, key, kind in (('recibo_scheduler_queue_depth', 'queued', 'gauge'),
+                              ('recibo_scheduler_in_use', 'in_use', 'gauge'),
+                              ('recibo_scheduler_granted_total', 'granted', 'counter')):
+        lines.append(f'# TYPE {metric} {kind}')
+        for name, snapshot in snapshots:
+            for class_name, class_stats in snapshot['classes'].items():
+                lines.append(f'{metric}{{resource="{name}",class="{class_name}"}} {class_stats[key]}')
+    lines.append('# TYPE recibo_scheduler_wait_seconds histogram')
+    for name, snapshot in snapshots:
+        for class_name, class_stats in snapshot['classes'].items():
+            labels = f'resource="{name}",class="{class_name}"'
+            cumulative = 0
+            for bound, count in zip(WAIT_BUCKETS + ('+Inf',), class_stats['buckets']):
+                cumulative += count
+                lines.append(f'recibo_scheduler_wait_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'recibo_scheduler_wait_seconds_sum{{{labels}}} {class_stats["wait_sum"]:.6f}')
+            lines.append(f'recibo_scheduler_wait_seconds_count{{{labels}}} {class_stats["granted"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,303 @@
+"""
+Long-running HTTP service around main.lambda_handler.
+
+Runs the same handler outside Lambda (e.g. in a container behind a load
+balancer) so fonts, caches and SMTP sessions stay warm between requests:
+
+    python server.py --port 8080 --workers 8
+
+POST any path with the receipt JSON as the body; the response is the
+handler's statusCode, headers and body. GET /healthz and GET /metrics are
+served directly. Requests are interactive work for the scheduler unless they
+carry an X-Recibo-Priority: bulk header.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import logging
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import main
+import scheduler
+
+logger = logging.getLogger('email_service')
+
+DEFAULT_WORKERS = int(os.environ.get('SERVER_WORKERS', '4'))
+DEFAULT_MAX_BODY = int(os.environ.get('SERVER_MAX_BODY', str(1024 * 1024)))    # bytes
+DEFAULT_KEEPALIVE = float(os.environ.get('SERVER_KEEPALIVE_TIMEOUT', '15'))   # seconds
+DEFAULT_MAX_CONNECTIONS = int(os.environ.get('SERVER_MAX_CONNECTIONS', '256'))
+
+_BUSY_BODY = json.dumps({'error': 'Too many connections'}).encode('utf-8')
+_BUSY_RESPONSE = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+                  b'Content-Length: %d\r\nConnection: close\r\n\r\n' % len(_BUSY_BODY)) + _BUSY_BODY
+
+
+class Metrics:
+    """Request counters exported on /metrics in Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = {}          # status code -> count
+        self.in_flight = 0
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, status, elapsed):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests[status] = self.requests.get(status, 0) + 1
+            self.latency_sum += elapsed
+            self.latency_count += 1
+
+    def render(self):
+        with self._lock:
+            lines = [
+                '# TYPE recibo_requests_total counter',
+            ]
+            for status, count in sorted(self.requests.items()):
+                lines.append(f'recibo_requests_total{{status="{status}"}} {count}')
+            lines += [
+                '# TYPE recibo_requests_in_flight gauge',
+                f'recibo_requests_in_flight {self.in_flight}',
+                '# TYPE recibo_request_seconds summary',
+                f'recibo_request_seconds_sum {self.latency_sum:.6f}',
+                f'recibo_request_seconds_count {self.latency_count}',
+                '# TYPE recibo_uptime_seconds gauge',
+                f'recibo_uptime_seconds {time.time() - self.started_at:.0f}',
+            ]
+        outbox = main.get_outbox()
+        if outbox is not None:
+            lines.append('# TYPE recibo_outbox_messages gauge')
+            for status, count in sorted(outbox.counts().items()):
+                lines.append(f'recibo_outbox_messages{{status="{status}"}} {count}')
+        return '\n'.join(lines) + '\n' + scheduler.render_metrics()
+
+
+class ReceiptRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'     # keep-alive
+    server_version = 'recibo'
+
+    def do_GET(self):
+        if self.path == '/healthz':
+            if self.server.draining:
+                self._reply(503, 'application/json', json.dumps({'status': 'draining'}))
+            else:
+                self._reply(200, 'application/json', json.dumps({'status': 'ok'}))
+        elif self.path == '/metrics':
+            self._reply(200, 'text/plain; version=0.0.4', self.server.metrics.render())
+        else:
+            self._reply(404, 'application/json', json.dumps({'error': 'Not found'}))
+
+    def do_POST(self):
+        length = self.headers.get('Content-Length')
+        if length is None:
+            self._reply(411, 'application/json', json.dumps({'error': 'Content-Length required'}))
+            return
+        try:
+            length = int(length)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # rfile.read() with a negative length reads until EOF, past max_body
+            self._reply(400, 'application/json', json.dumps({'error': 'Invalid Content-Length'}))
+            return
+        if length > self.server.max_body:
+            # The body is not read, so the connection cannot be reused
+            self.close_connection = True
+            self._reply(413, 'application/json', json.dumps({'error': 'Request body too large'}))
+            return
+        try:
+            body = self.rfile.read(length).decode('utf-8')
+        except UnicodeDecodeError:
+            self._reply(400, 'application/json', json.dumps({'error': 'Request body is not valid UTF-8'}))
+            return
+
+        # Same shape as an API Gateway proxy event
+        event = {
+            'httpMethod': 'POST',
+            'path': self.path,
+            'headers': dict(self.headers.items()),
+            'body': body,
+        }
+        if not self.server.begin_request():
+            self.close_connection = True
+            self._reply(503, 'application/json', json.dumps({'error': 'Server is draining'}))
+            return
+        metrics = self.server.metrics
+        metrics.begin()
+        started = time.perf_counter()
+        status = 500
+        try:
+            # Only handler calls are limited to the worker count; idle
+            # keep-alive connections and GETs never wait for a worker
+            with self.server.handler_slots:
+                response = main.lambda_handler(event, None)
+            status = response.get('statusCode', 200)
+            headers = response.get('headers') or {}
+            self._reply(status, headers.get('Content-Type', 'application/json'),
+                        response.get('body', ''), headers)
+        finally:
+            metrics.end(status, time.perf_counter() - started)
+            # Only now is the response fully written, so drain() may proceed
+            self.server.end_request()
+
+    def _reply(self, status, content_type, body, headers=None):
+        payload = body.encode('utf-8') if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            if name.lower() not in ('content-type', 'content-length'):
+                self.send_header(name, value)
+        if self.server.draining:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.address_string(), *args)
+
+
+class ReceiptHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTPServer with one thread per connection and at most `workers` handler
+    calls at a time.
+
+    Connections are cheap threads that mostly sit in keep-alive reads, so a
+    load balancer's pooled idle connections cannot starve real requests or
+    /healthz; only lambda_handler calls take one of the worker slots.
+    """
+
+    daemon_threads = True
+    # drain() waits for in-flight requests instead of joining idle connections
+    block_on_close = False
+
+    def __init__(self, address, workers=DEFAULT_WORKERS, max_body=DEFAULT_MAX_BODY,
+                 keepalive_timeout=DEFAULT_KEEPALIVE, max_connections=DEFAULT_MAX_CONNECTIONS):
+        # Idle keep-alive connections are closed after this long
+        ReceiptRequestHandler.timeout = keepalive_timeout
+        super().__init__(address, ReceiptRequestHandler)
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.draining = False
+        self.workers = workers
+        self.handler_slots = threading.BoundedSemaphore(workers)
+        # POST requests between reading the body and writing the last byte
+        # of the response
+        self._in_flight = 0
+        self._idle = threading.Condition()
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+    def process_request(self, request, client_address):
+        if not self._connections.acquire(blocking=False):
+            logger.warning("Connection limit reached, refusing %s", client_address[0])
+            try:
+                request.sendall(_BUSY_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        super().process_request(request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._connections.release()
+
+    def handle_error(self, request, client_address):
+        error = sys.exc_info()[1]
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            # Clients dropping keep-alive connections are routine
+            logger.debug("Connection from %s closed: %s", client_address[0], error)
+        else:
+            logger.error("Error handling request from %s", client_address[0], exc_info=True)
+
+    def begin_request(self):
+        """Count a request as in flight; False once the server is draining."""
+        with self._idle:
+            if self.draining:
+                return False
+            self._in_flight += 1
+            return True
+
+    def end_request(self):
+        with self._idle:
+            self._in_flight -= 1
+            if not self._in_flight:
+                self._idle.notify_all()
+
+    def drain(self):
+        """
+        Stop accepting connections, finish in-flight requests and flush the
+        outbox. Only the first call drains; later calls return at once.
+        """
+        with self._idle:
+            if self.draining:
+                return
+            self.draining = True
+        self.shutdown()
+        # Connection threads are daemons, so wait until every response has
+        # been written before letting the process exit
+        with self._idle:
+            self._idle.wait_for(lambda: not self._in_flight)
+        self.server_close()
+        worker = main._outbox_worker
+        if worker is not None:
+            worker.stop(drain=True)
+        main.close_smtp_sessions()
+        logger.info("Server drained")
+
+
+def run(host='0.0.0.0', port=8080, workers=DEFAULT_WORKERS, max_body=DEFAULT_MAX_BODY,
+        keepalive_timeout=DEFAULT_KEEPALIVE, max_connections=DEFAULT_MAX_CONNECTIONS):
+    """Serve until SIGTERM or SIGINT, then drain gracefully."""
+    # Sessions to the SMTP server are worth keeping open in a long-lived
+    # process; one per worker covers every handler call sending at once
+    main.SMTP_KEEPALIVE = True
+    main.configure_smtp_pool(workers)
+    server = ReceiptHTTPServer((host, port), workers, max_body, keepalive_timeout, max_connections)
+    # Start the outbox worker up front when one is configured
+    main.get_outbox()
+
+    def handle_signal(signum, frame):
+        if server.draining:
+            logger.info("Received signal %s, already draining", signum)
+            return
+        logger.info("Received signal %s, draining", signum)
+        # shutdown() blocks until serve_forever returns, so call it elsewhere
+        threading.Thread(target=server.drain, name='recibo-drain').start()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    logger.info("Listening on %s:%s with %s workers", host, port, workers)
+    server.serve_forever()
+    return server
+
+
+def cli():
+    parser = argparse.ArgumentParser(description='Receipt HTTP service')
+    parser.add_argument('--host', default=os.environ.get('SERVER_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('SERVER_PORT', '8080')))
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS)
+    parser.add_argument('--max-body', type=int, default=DEFAULT_MAX_BODY, help='bytes')
+    parser.add_argument('--keepalive-timeout', type=float, default=DEFAULT_KEEPALIVE, help='seconds')
+    parser.add_argument('--max-connections', type=int, default=DEFAULT_MAX_CONNECTIONS)
+    args = parser.parse_args()
+    run(args.host, args.port, args.workers, args.max_body, args.keepalive_timeout, args.max_connections)
+
+
+if __name__ == '__main__':
+    cli()